@@ -5,109 +5,348 @@ homesrv-html
 """
 
 from datetime import datetime, timedelta
-import html.entities
+import hashlib
+import json
 import logging
+import threading
 import time
 import signal
 import os
-import html
+from concurrent.futures import ThreadPoolExecutor, wait
 from homesrv.config import cfg
+from homesrv.files import write_atomic
+from homesrv.htmlescape import escape, sanitize
+from homesrv.metrics import metrics, count_cache
+from homesrv.template import HtmlTemplate
+from homesrv.webcontent import WebContent
 from homesrvAPI.awidoAPI import awidoAPI
 from homesrvAPI.openweathermapAPI import openweathermapAPI
 from homesrvAPI.DBtimetableAPI import DBtimetableAPI
 from homesrvAPI.DBdisruptionsAPI import DBdisruptionsAPI
 from homesrvAPI.ninaAPI import ninaAPI
 
+#================================================
+# Immutable rendering of the html page, handed out to concurrent readers.
+# Compressed variants are created once per snapshot - not per request.
+# etag and mtime reflect the data sections only (not the refresh timestamp).
+# api holds the serialized JSON data: path -> WebContent
+# sections holds the rendered html snippets: placeholder -> html
+class HomeSrvSnapshot:
+    def __init__(self, html_data, created, etag=None, mtime=None, api=None, sections=None, sequence=0):
+        self.html_data = html_data
+        self.content = html_data.encode("utf-8")
+        self.created = created
+        self.webcontent = WebContent(self.content, "text/html; charset=utf-8", mtime=mtime or created.timestamp(), etag=etag)
+        self.api = api if api else {}
+        self.sections = sections if sections else {}
+        self.sequence = sequence
+
 #================================================
 class HomeSrvHtml:
+    placeholders = ("CurrentDateTime", "weather", "Nina", "Waste", "DBtimetable", "DBdisruptions")
+
     def __init__(self):
         self.last_update = None
         self.html_data = None
+        self.snapshot = None
+        self._refresh_lock = threading.Lock()
+        self._snapshot_cond = threading.Condition()  # notified on new snapshots
+        self._stop_event = threading.Event()
+        self._refresh_thread = None
+        self.fragments = {}  # rendered sections: placeholder -> (data version, html)
+        self.executor = None  # retrieves source data concurrently
+        self.pending = {}     # source key -> future of a retrieval which is still running
+        self.results = {}     # source key -> last retrieved data (served stale on timeouts)
         self._initialize()
 
+    #-------------------------------------------
+    # Start background thread which keeps the snapshot up to date
+    def start(self):
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._refresh_thread = threading.Thread(target=self._refresh_loop, name="html-refresh", daemon=True)
+        self._refresh_thread.start()
+        logging.info("Background html refresh started")
+
+    #-------------------------------------------
+    def stop(self):
+        self._stop_event.set()
+        with self._snapshot_cond:
+            self._snapshot_cond.notify_all()
+        if self._refresh_thread:
+            self._refresh_thread.join(timeout=5)
+            self._refresh_thread = None
+            logging.info("Background html refresh stopped")
+        if self.executor:
+            for future in self.pending.values(): # cancel_futures of shutdown() requires python 3.9
+                future.cancel()
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            self.pending.clear()
+
+    #-------------------------------------------
+    def is_running(self):
+        return self._refresh_thread is not None and self._refresh_thread.is_alive()
+
+    #-------------------------------------------
+    def is_stopped(self):
+        return self._stop_event.is_set()
+
+    #-------------------------------------------
+    # Returns the latest rendered snapshot (or None if nothing has been rendered yet)
+    def get_snapshot(self):
+        return self.snapshot
+
+    #-------------------------------------------
+    # Blocks until a snapshot other than `sequence` is available; returns None on timeout or stop
+    def wait_for_snapshot(self, sequence, timeout=None):
+        with self._snapshot_cond:
+            self._snapshot_cond.wait_for(lambda: self._stop_event.is_set() or (self.snapshot and self.snapshot.sequence != sequence), timeout)
+            if self._stop_event.is_set() or not self.snapshot or self.snapshot.sequence == sequence:
+                return None
+            return self.snapshot
+
+    #-------------------------------------------
+    def _refresh_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error("Error while refreshing html data: {}".format(str(e)))
+            self._stop_event.wait(1 if self._is_warming_up() else cfg.get("HTML_REFRESH", 60))
+
     #-------------------------------------------
     def refresh(self):
+        with self._refresh_lock:
+            self._refresh()
+
+    #-------------------------------------------
+    def _refresh(self):
         now = datetime.now()
-        if not self.last_update or now > self.last_update + timedelta(seconds=cfg.get("HTML_REFRESH", 60)):
-            logging.info("Refreshing html data")
-            html_data = self._read_html_template()
+        stale = not self.last_update or now > self.last_update + timedelta(seconds=cfg.get("HTML_REFRESH", 60)) or self._is_warming_up()
+        count_cache("html", not stale)
+        if stale:
+            with metrics.timer("homesrv_html_refresh_seconds", help="Duration of a html refresh incl. data retrieval"):
+                self._render(now)
+
+    #-------------------------------------------
+    def _render(self, now):
+        logging.info("Refreshing html data")
+        if not self.template.refresh():
+            return
+        self._initialize_apis()
+        sections = {}
+        api_data = {}  # data exposed via JSON API: path -> data
+        results = self._gather(self._get_tasks()) # source key -> (data version, data) - the version is read along with the data
+
+        if self.api_nina: # nina Wetterwarnungen
+            items = [result for key, result in results.items() if key[0] == "nina" and result and result[1]]
+            version = tuple(generation for generation, _ in items)
+            data = [warnings for _, warnings in items]
+            sections['Nina'] = self._render_section('Nina', version, self._get_nina_snippet, data)
+            for item in data:
+                api_data["nina/{}".format(item["ars"])] = item
 
-            if self.api_nina: # nina Wetterwarnungen
-                snippet = self._get_nina_snippet()    
-                html_data = html_data.replace('%%Nina%%', snippet)
+        generation, data = results.get(("awido",)) or (None, None)
+        if data: # Abfall
+            version = (generation, now.date()) # upcoming collections depend on the date
+            sections['Waste'] = self._render_section('Waste', version, self._get_awido_snippet, data)
+            api_data["waste/current"] = data["current"]
+            api_data["waste/upcoming"] = data["upcoming"]
 
-            if self.api_awido: # Abfall
-                snippet = self._get_awido_snippet()    
-                html_data = html_data.replace('%%Waste%%', snippet)
+        if self.api_db: # Deutsche Bahn: Abfahrt
+            items = [result for key, result in results.items() if key[0] == "db" and result and result[1]]
+            version = (tuple(generation for generation, _ in items), now.strftime("%Y%m%d%H%M")) # departed trains disappear
+            data = [item for _, item in items]
+            sections['DBtimetable'] = self._render_section('DBtimetable', version, self._get_db_snippet, data)
+            for item in data:
+                api_data["db/{}".format(item["base"]["station_id"])] = item["base"]
+                api_data["db/{}/departure".format(item["base"]["station_id"])] = item["departure"]
 
-            if self.api_db: # Deutsche Bahn: Abfahrt
-                snippet = self._get_db_snippet()    
-                html_data = html_data.replace('%%DBtimetable%%', snippet)
+        generation, data = results.get(("disruptions",)) or (None, None)
+        if data is not None: # Deutsche Bahn: Störungen
+            sections['DBdisruptions'] = self._render_section('DBdisruptions', generation, self._get_disruptions_snippet, data)
+            api_data["db/disruptions"] = data
 
-            if self.api_disruptions: # Deutsche Bahn: Störungen
-                snippet = self._get_disruptions_snippet()    
-                html_data = html_data.replace('%%DBdisruptions%%', snippet)
+        if self.api_weather: # Weather
+            items = {key[1]: result for key, result in results.items() if key[0] == "weather" and result and result[1]}
+            version = tuple((location, generation) for location, (generation, _) in items.items())
+            data = {location: weather for location, (_, weather) in items.items()}
+            sections['weather'] = self._render_section('weather', version, self._get_weather_snippet, data)
+            for location, weather in data.items():
+                api_data["weather/{}".format(location)] = weather
+                for category, v in weather.items():
+                    api_data["weather/{}/{}".format(location, category)] = v
 
-            if self.api_weather: # Weather
-                snippet = self._get_weather_snippet()    
-                html_data = html_data.replace('%%weather%%', snippet)
+        # Content hash of template and data sections -> validator for conditional requests
+        data_hash = hashlib.sha1(self.template.digest)
+        for snippet in sections.values():
+            data_hash.update(snippet.encode("utf-8"))
+        etag = 'W/"{}"'.format(data_hash.hexdigest())  # weak: the refresh timestamp may differ
 
-            # Current Date/Time
-            snippet = '<div class="refresh-date">Aktualisiert am: {}</div>\n'.format(now.strftime("%d.%m.%Y %H:%M:%S"))
-            html_data = html_data.replace('%%CurrentDateTime%%', snippet)
+        # Current Date/Time; data-sequence tells live update clients which snapshot they show 
+        sequence = self.snapshot.sequence + 1 if self.snapshot else 1
+        snippet = '<div class="refresh-date" data-sequence="{}">Aktualisiert am: {}</div>\n'.format(sequence, now.strftime("%d.%m.%Y %H:%M:%S"))
+        sections['CurrentDateTime'] = snippet
+        html_data = self.template.render(sections)
 
-            self.last_update = now
-            self.html_data = html_data
+        mtime = None
+        if self.snapshot and self.snapshot.webcontent.etag == etag: # unchanged data -> keep Last-Modified
+            mtime = self.snapshot.webcontent.mtime
+        self.last_update = now
+        self.html_data = html_data
+        snapshot = HomeSrvSnapshot(html_data, now, etag=etag, mtime=mtime, api=self._serialize_api_data(api_data), sections=sections, sequence=sequence)
+        with self._snapshot_cond:
+            self.snapshot = snapshot
+            self._snapshot_cond.notify_all()
 
     #-------------------------------------------
-    def _initialize(self):
-        # Create html entity replacement table
-        self.html_map = {k: '&{};'.format(v) for k, v in html.entities.codepoint2name.items()}
-        self.html_preserve_tags = self.html_map
-        del self.html_preserve_tags[38]  # &
-        del self.html_preserve_tags[60]  # <
-        del self.html_preserve_tags[62]  # >
-
-        # initialite APIs
-        self.api_awido = awidoAPI()
-        self.api_db = DBtimetableAPI()
-        self.api_disruptions = DBdisruptionsAPI()
-        self.api_weather = openweathermapAPI()
-        self.api_nina = ninaAPI()
+    # Render a section only if its data version changed since the last rendering
+    def _render_section(self, section, version, render_func, data):
+        fragment = self.fragments.get(section)
+        count_cache("html_section", fragment is not None and fragment[0] == version)
+        if fragment and fragment[0] == version:
+            return fragment[1]
+        with metrics.timer("homesrv_html_render_seconds", {"section": section}, help="Duration of rendering a html section"):
+            snippet = render_func(data)
+        self.fragments[section] = (version, snippet)
+        return snippet
 
     #-------------------------------------------
-    def _read_file(self, fname):
-        try:
-            with open(fname, "r") as file: 
-                data = file.read()   
-                return data
-        except Exception as ex:
-            logging.debug("Couldn't read {}: {}".format(fname, ex))
-            return None
+    # Data retrieval tasks: source key -> (function, args); the order defines the rendering order.
+    # The functions return (data version, data)
+    def _get_tasks(self):
+        tasks = {}
+        if self.api_nina:
+            for location in self.api_nina.locations:
+                tasks[("nina", location["ars"])] = (self._get_nina_data, (location["ars"],))
+        if self.api_awido:
+            tasks[("awido",)] = (self._get_awido_data, ())
+        if self.api_db:
+            for dbstation in self.api_db.get_dbstations():
+                tasks[("db", dbstation.station_id)] = (self._get_dbstation_data, (dbstation,))
+        if self.api_disruptions:
+            tasks[("disruptions",)] = (self._get_disruptions_data, ())
+        if self.api_weather:
+            for location in self.api_weather.get_locations():
+                tasks[("weather", location)] = (self._get_weather_data, (location,))
+        return tasks
+
+    #-------------------------------------------
+    # Run the tasks concurrently and wait at most HTML_SOURCE_TIMEOUT seconds for them.
+    # Sources which fail or don't respond in time contribute their last data (stale).
+    # A source whose previous retrieval is still running isn't submitted again.
+    def _gather(self, tasks):
+        self._submit(tasks)
+        futures = [self.pending[key] for key in tasks]
+        done, not_done = wait(futures, timeout=cfg.get("HTML_SOURCE_TIMEOUT", 15))
+
+        results = {}
+        for key in tasks:
+            future = self.pending[key]
+            if future in not_done:
+                logging.warning("Data retrieval for {} timed out - using stale data".format("/".join(str(k) for k in key)))
+                metrics.inc("homesrv_html_source_timeouts_total", {"source": key[0]}, help="Source retrievals which didn't finish in time")
+            else:
+                del self.pending[key]
+                try:
+                    self.results[key] = future.result()
+                except Exception as e:
+                    logging.error("Data retrieval for {} failed - using stale data: {}".format("/".join(str(k) for k in key), str(e)))
+                    metrics.inc("homesrv_html_source_errors_total", {"source": key[0]}, help="Source retrievals which failed")
+            results[key] = self.results.get(key)
+        return results
+
+    #-------------------------------------------
+    # Submit the tasks which aren't running yet
+    def _submit(self, tasks):
+        if not self.executor:
+            self.executor = ThreadPoolExecutor(max_workers=cfg.get("HTML_REFRESH_WORKERS", 4), thread_name_prefix="html-source")
+        for key, (func, args) in tasks.items():
+            if key not in self.pending:
+                self.pending[key] = self.executor.submit(func, *args)
+
+    #-------------------------------------------
+    # Serialize JSON API data; unchanged data keeps its WebContent (incl. compressed variants)
+    def _serialize_api_data(self, api_data):
+        previous = self.snapshot.api if self.snapshot else {}
+        api_data[""] = sorted(api_data.keys())  # index: list of available paths 
+        api = {}
+        for path, data in api_data.items():
+            content = json.dumps(data, ensure_ascii=False, default=str).encode("utf-8")
+            item = previous.get(path)
+            if not item or item.content != content:
+                item = WebContent(content, "application/json")
+            api[path] = item
+        return api
 
     #-------------------------------------------
-    def _read_html_template(self):
+    def _initialize(self):
+        # Try index.html (user generated) and use index-template.html as fallback
         html_path = cfg["WEB_ROOT"]     # Web root directory
-        fname_user = os.path.join(html_path, "index.html") 
-        fname_template = os.path.join(html_path, "index-template.html")
-        # Try to read index.html (user generated) and use index-template.html as fallback
-        data = self._read_file(fname_user)
-        if not data: 
-            data = self._read_file(fname_template)  
-        if not data:
-            logging.critical("Couldn't read {}: {}".format(fname, ex))
-        return data    
+        templates = [os.path.join(html_path, "index.html"), os.path.join(html_path, "index-template.html")]
+        if cfg.get("HTML_EXPORT"): # the exported page must not be picked up as template
+            export_fname = os.path.join(get_export_root(), "index.html")
+            templates = [fname for fname in templates if os.path.abspath(fname) != os.path.abspath(export_fname)]
+        self.template = HtmlTemplate(templates, self.placeholders)
+
+        # APIs are created on first use (see _initialize_apis): api attribute -> (enable flag, class)
+        self.sources = {
+            "api_awido": ("HTML_enable_awido", awidoAPI),
+            "api_db": ("HTML_enable_db", DBtimetableAPI),
+            "api_disruptions": ("HTML_enable_db", DBdisruptionsAPI),
+            "api_weather": ("HTML_enable_weather", openweathermapAPI),
+            "api_nina": ("HTML_enable_nina", ninaAPI),
+        }
+        for attr in self.sources:
+            setattr(self, attr, None)
+
+    #-------------------------------------------
+    # Create the enabled APIs which don't exist yet. Some of them download larger data sets
+    # on creation (DB station list, ARS list) -> they are created concurrently like the data
+    # retrieval. The refresh doesn't wait for them: only APIs which are ready are used, the
+    # others are picked up by a later refresh; APIs which fail are retried.
+    # Runs with the refresh lock held.
+    def _initialize_apis(self):
+        tasks = {}
+        for attr, (flag, api_class) in self.sources.items():
+            if getattr(self, attr) is None and cfg.get(flag, True):
+                tasks[("init", attr)] = (api_class, ())
+        self._submit(tasks)
+        for key in tasks:
+            future = self.pending[key]
+            if not future.done():
+                continue
+            del self.pending[key]
+            try:
+                api = future.result()
+            except Exception as e:
+                logging.error("Initialization of {} failed - retrying: {}".format(key[1], str(e)))
+                metrics.inc("homesrv_html_source_errors_total", {"source": key[0]}, help="Source retrievals which failed")
+                continue
+            setattr(self, key[1], api)
+            logging.info("{} initialized".format(type(api).__name__))
+
+    #-------------------------------------------
+    # True while enabled APIs are still being created
+    def _is_warming_up(self):
+        return any(key[0] == "init" for key in self.pending)
+
+    #----------------------------------
+    def _get_nina_data(self, ars):
+        warnings = self.api_nina.get_warnings(ars)
+        return (self.api_nina.get_generation(ars), warnings)
 
     #----------------------------------
-    def _get_nina_snippet(self):    
+    def _get_nina_snippet(self, nina_data):    
         snippet = '<div class="nina">\n'
-        for location in self.api_nina.locations:
+        for data in nina_data:
             snippet += '<div class="nina-location">\n'
-            snippet += '<h3>{}</h3>\n'.format(location["location"].translate(self.html_map))
-            data = self.api_nina.get_warnings(ars=location["ars"])
+            snippet += '<h3>{}</h3>\n'.format(escape(data["location"]))
             if len(data["warnings"]) == 0:
                 snippet += '<div class="nina-nowarnings">\n'
-                snippet += 'Keine Warnungen\n'.translate(self.html_map)
+                snippet += 'Keine Warnungen\n'
                 snippet += '</div>\n\n'
             else:
                 for item in data["warnings"]:
@@ -121,42 +360,56 @@ class HomeSrvHtml:
                         css_class = "nina-warning-minimal"
 
                     snippet += '<div class="{}">\n'.format(css_class)
-                    snippet += '  <div class="nina-warning-headline"><img src="images/alert.png" alt="alert" title="Achtung!">{} ({})</div>\n'.format(item["headline"].translate(self.html_map), 
-                                                                                        item["severity"].translate(self.html_map)) 
-                    snippet += '  <div class="nina-warning-desc">{}</div>\n'.format(item["description"].translate(self.html_map))
+                    snippet += '  <div class="nina-warning-headline"><img src="images/alert.png" alt="alert" title="Achtung!">{} ({})</div>\n'.format(escape(item["headline"]), 
+                                                                                        escape(item["severity"])) 
+                    snippet += '  <div class="nina-warning-desc">{}</div>\n'.format(escape(item["description"]))
                     snippet += '</div>\n\n'
             snippet += '</div>\n\n'
         snippet += '</div>\n\n'
         return snippet    
 
     #----------------------------------
-    def _get_awido_snippet(self):    
+    def _get_awido_data(self):
+        data = {}
+        data["title"] = self.api_awido.title
+        data["current"] = self.api_awido.current_collections()
+        data["upcoming"] = self.api_awido.upcoming_collections()
+        return (self.api_awido.generation, data)
+
+    #----------------------------------
+    def _get_awido_snippet(self, data):    
         snippet = '<div class="waste">\n'
-        snippet += '<h3>{}</h3>\n'.format(self.api_awido.title.translate(self.html_map))
+        snippet += '<h3>{}</h3>\n'.format(escape(data["title"]))
         snippet += '<table class="waste-table">\n'
         snippet += '<tr>\n'
         snippet += '  <th>Datum</th>\n'
         snippet += '  <th>Typ</th>\n'
         snippet += '  <th>Ort</th>\n'
         snippet += '</tr>\n'
-        for item in self.api_awido.upcoming_collections():
+        for item in data["upcoming"]:
             snippet += '<tr>\n'
-            snippet += '  <td>{}</td>\n'.format(item["date"].translate(self.html_map))
-            snippet += '  <td>{}</td>\n'.format(item["waste_type"].translate(self.html_map))
-            snippet += '  <td>{}</td>\n'.format(item["site"].translate(self.html_map))
+            snippet += '  <td>{}</td>\n'.format(escape(item["date"]))
+            snippet += '  <td>{}</td>\n'.format(escape(item["waste_type"]))
+            snippet += '  <td>{}</td>\n'.format(escape(item["site"]))
             snippet += '</tr>\n'
         snippet += '</table>\n'
         snippet += '</div>\n\n'    
         return snippet    
 
     #----------------------------------
-    def _get_db_snippet(self):
+    def _get_dbstation_data(self, dbstation):
+        dbstation.refresh(self.api_db, dt=None)
+        item = {}
+        item["base"] = dbstation.get_station_base_data()
+        item["departure"] = dbstation.get_timetable(tt_type="departure").get_timetable()
+        return (dbstation.generation, item)
+
+    #----------------------------------
+    def _get_db_snippet(self, db_data):
         snippet = '<div class="db">\n'
-        for dbstation in self.api_db.get_dbstations():
-            dbstation.refresh(self.api_db, dt=None)
-            dbtt = dbstation.get_timetable(tt_type="departure")
+        for data in db_data:
             snippet += '<div class="db-location">\n'
-            snippet += '<h3>{}</h3>\n'.format(dbstation.station_name.translate(self.html_map))
+            snippet += '<h3>{}</h3>\n'.format(escape(data["base"]["station_name"]))
             snippet += '<table class="db-table">\n'
             snippet += '<tr>\n'
             snippet += '  <th>Zeit</th>\n'
@@ -165,7 +418,7 @@ class HomeSrvHtml:
             snippet += '  <th>Gleis</th>\n'
             snippet += '  <th>Status</th>\n'
             snippet += '</tr>\n'
-            for item in dbtt.timetable:
+            for item in data["departure"]:
                 dtime = datetime.strptime(item["date"], "%d.%m.%Y %H:%M")
                 if item.get("scheduled_date"):    
                     dtime_scheduled = datetime.strptime(item["scheduled_date"], "%d.%m.%Y %H:%M")
@@ -185,11 +438,11 @@ class HomeSrvHtml:
                     status += " ! " + item.get("message") + " !"    
 
                 snippet += '<tr>\n'
-                snippet += '  <td>{}</td>\n'.format(time_str.translate(self.html_map))
-                snippet += '  <td>{}</td>\n'.format(item["train"].translate(self.html_map))
-                snippet += '  <td>{}</td>\n'.format(from_to.translate(self.html_map))
-                snippet += '  <td>{}</td>\n'.format(platform.translate(self.html_map))
-                snippet += '  <td>{}</td>\n'.format(status.translate(self.html_map))
+                snippet += '  <td>{}</td>\n'.format(escape(time_str))
+                snippet += '  <td>{}</td>\n'.format(escape(item["train"]))
+                snippet += '  <td>{}</td>\n'.format(escape(from_to))
+                snippet += '  <td>{}</td>\n'.format(escape(platform))
+                snippet += '  <td>{}</td>\n'.format(escape(status))
                 snippet += '</tr>\n'
             snippet += '</table>\n'
             snippet += '</div>\n\n'
@@ -197,42 +450,52 @@ class HomeSrvHtml:
         return snippet    
 
     #----------------------------------
-    def _get_disruptions_snippet(self):
+    def _get_disruptions_data(self):
+        disruptions = self.api_disruptions.get_disruptions()
+        return (self.api_disruptions.generation, disruptions)
+
+    #----------------------------------
+    def _get_disruptions_snippet(self, data):
         snippet = '<div class="db-disruptions">\n'
-        for item in self.api_disruptions.get_disruptions():
+        for item in data:
             snippet += '<div class="db-disruption">\n'
             snippet += '<div class="db-disruption-lines">\n'
             for i in item["lines"]:
-                snippet += '  <div class="db-disruption-line-item">{}</div>\n'.format(i["name"])
+                snippet += '  <div class="db-disruption-line-item">{}</div>\n'.format(escape(i["name"]))
             snippet += '</div>\n'
-            snippet += '  <div class="db-disruption-headline">{}</div>\n'.format(item["headline"].translate(self.html_map))
-            snippet += '  <div class="db-disruption-reason">{}</div>\n'.format(item["cause"]["label"].translate(self.html_map))
+            snippet += '  <div class="db-disruption-headline">{}</div>\n'.format(escape(item["headline"]))
+            snippet += '  <div class="db-disruption-reason">{}</div>\n'.format(escape(item["cause"]["label"]))
             snippet += '  <details>\n' 
-            snippet += '    <summary class="db-disruption-summary">{}</summary>\n'.format(item["summary"].translate(self.html_map))
-            snippet += '    <div class="db-disruption-text">{}</div>\n'.format(item["text"].translate(self.html_preserve_tags))
+            snippet += '    <summary class="db-disruption-summary">{}</summary>\n'.format(escape(item["summary"]))
+            snippet += '    <div class="db-disruption-text">{}</div>\n'.format(sanitize(item["text"]))
             snippet += '  </details>\n' 
             snippet += '</div>\n\n'
         snippet += '</div>\n\n'    
         return snippet    
 
     #----------------------------------
-    def _get_weather_snippet(self):
+    def _get_weather_data(self, location):
+        weather = self.api_weather.get_weather(location)
+        return (self.api_weather.get_generation(location), weather)
+
+    #----------------------------------
+    def _get_weather_snippet(self, weather_data):
         snippet = '<div class="weather">\n'
-        for item in self.api_weather.get_locations():
-            snippet += '<h3>{}</h3>\n'.format(item.translate(self.html_map))
+        for item, weather in weather_data.items():
+            snippet += '<h3>{}</h3>\n'.format(escape(item))
 
-            data = self.api_weather.get_weather(item, 'now')
+            data = weather['now']
             snippet += '<div class="weather-location">\n'
 
             snippet += '<div class="weather-overview">\n'
             snippet += '<div class="weather-generic">\n'
-            snippet += '  <img src="images/sunrise.png" alt="sunrise" title="Sonnenaufgang">{} Uhr\n'.format(data['sunrise_txt'])
-            snippet += '  <img src="images/sunset.png" alt="sunset" title="Sonnenuntergang">{} Uhr\n'.format(data['sunset_txt'])
-            snippet += '  <img src="images/uvidx.png" alt="uv index" title="UV-Index">{}\n'.format(data['uv_index_txt'].translate(self.html_map))
+            snippet += '  <img src="images/sunrise.png" alt="sunrise" title="Sonnenaufgang">{} Uhr\n'.format(escape(data['sunrise_txt']))
+            snippet += '  <img src="images/sunset.png" alt="sunset" title="Sonnenuntergang">{} Uhr\n'.format(escape(data['sunset_txt']))
+            snippet += '  <img src="images/uvidx.png" alt="uv index" title="UV-Index">{}\n'.format(escape(data['uv_index_txt']))
             snippet += '</div>\n'
             snippet += '<div class="weather-situation">\n'
-            snippet += '  <img src="images/{}" alt="weather situation" title="Wetterlage">\n'.format(data['icon'])
-            snippet += '  <p>{}</p>\n'.format(data['description'].translate(self.html_map))
+            snippet += '  <img src="images/{}" alt="weather situation" title="Wetterlage">\n'.format(escape(data['icon']))
+            snippet += '  <p>{}</p>\n'.format(escape(data['description']))
             snippet += '</div>\n'
             snippet += '</div>\n'
 
@@ -241,10 +504,10 @@ class HomeSrvHtml:
             snippet += '<li><img src="images/temp.png" alt="temperature" title="Temperatur">{}&#8451; (gef&uuml;hlt: {}&#8451;)</li>\n'.format(data['temp'], data['feels_like'])
             txt = ''
             if data.get("rain_txt"):
-                txt = ' - Regen: {}'.format(data['rain_txt'].translate(self.html_map))
+                txt = ' - Regen: {}'.format(escape(data['rain_txt']))
             if data.get("snow_txt"):
-                txt = ' - Schneefall: {}'.format(data['snow_txt'].translate(self.html_map))
-            snippet += '<li><img src="images/rainprop.png" alt="rainprop" title="Niederschlag">{}{}</li>\n'.format(data['precipitation_txt'].translate(self.html_map), txt)
+                txt = ' - Schneefall: {}'.format(escape(data['snow_txt']))
+            snippet += '<li><img src="images/rainprop.png" alt="rainprop" title="Niederschlag">{}{}</li>\n'.format(escape(data['precipitation_txt']), txt)
             snippet += '<li><img src="images/humidity.png" alt="humidity" title="Luftfeuchtigkeit">{}&percnt;</li>\n'.format(data['humidity'])
             snippet += '<li><img src="images/pressure.png" alt="pressure" title="Luftdruck">{}hPa</li>\n'.format(data['pressure'])
             txt = ''
@@ -252,12 +515,79 @@ class HomeSrvHtml:
                 txt = ' - B&ouml;en: {}km/h'.format(data['wind_gust_kmh'])
             snippet += '<li><img src="images/wind.png" alt="wind" title="Wind">{}km/h - {}{}</li>\n'.format(data['wind_speed_kmh'], data['wind_direction'], txt)
             snippet += '</ul>\n'
-            data = self.api_weather.get_weather(item, 'daytime')
             snippet += '</div>\n'    
             snippet += '</div>\n\n'
         snippet += '</div>\n\n'    
         return snippet    
 
+#================================================
+# Writes the rendered page (incl. precompressed siblings) and optionally the JSON API data
+# as static files, e.g. to be served by nginx (gzip_static). Files are only rewritten if
+# their data changed, and replaced atomically so readers never see partial files.
+# The sha1 of the last exported index.html is kept in .homesrv-export - an index.html which
+# doesn't match is a user file (e.g. a template in WEB_ROOT) and is never overwritten.
+class HomeSrvExport:
+    marker_fname = ".homesrv-export"
+
+    def __init__(self, export_root, with_json=False):
+        self.export_root = export_root
+        self.with_json = with_json
+        self.exported = {}  # file name -> validator of the exported data
+
+    #----------------------------------
+    # True if index.html doesn't exist or was written by the exporter
+    def is_safe(self):
+        fname = os.path.join(self.export_root, "index.html")
+        try:
+            with open(fname, "rb") as file:
+                digest = hashlib.sha1(file.read()).hexdigest()
+        except FileNotFoundError:
+            return True
+        try:
+            with open(os.path.join(self.export_root, self.marker_fname), "r", encoding="utf-8") as file:
+                return file.read().strip() == digest
+        except OSError:
+            return False
+
+    #----------------------------------
+    def export(self, snapshot):
+        if not snapshot:
+            return
+        item = snapshot.webcontent
+        self._export_webcontent("index.html", item, item.etag)
+        if self.with_json:
+            # all JSON API data as one document: path -> data
+            parts = ['{}:{}'.format(json.dumps(path, ensure_ascii=False), data.content.decode("utf-8")) for path, data in sorted(snapshot.api.items()) if path]
+            content = "{{{}}}".format(",".join(parts)).encode("utf-8")
+            validator = hashlib.sha1(content).hexdigest()
+            if self.exported.get("homesrv.json") != validator: # don't compress unchanged data
+                item = WebContent(content, "application/json", mtime=snapshot.created.timestamp())
+                self._export_webcontent("homesrv.json", item, validator)
+
+    #----------------------------------
+    def _export_webcontent(self, fname, item, validator):
+        if self.exported.get(fname) == validator:
+            return
+        fname_full = os.path.join(self.export_root, fname)
+        try:
+            write_atomic(fname_full, item.content, item.mtime)
+            for encoding, ext in (("gzip", ".gz"), ("br", ".br")):
+                if encoding in item.encodings:
+                    write_atomic(fname_full + ext, item.encodings[encoding], item.mtime)
+                elif os.path.exists(fname_full + ext): # outdated variant
+                    os.remove(fname_full + ext)
+            if fname == "index.html":
+                write_atomic(os.path.join(self.export_root, self.marker_fname), hashlib.sha1(item.content).hexdigest().encode("ascii"))
+        except OSError as e:
+            logging.error("Couldn't export {}: {}".format(fname_full, str(e)))
+            return
+        self.exported[fname] = validator
+        logging.info("Exported {}".format(fname_full))
+
+#----------------------------------
+def get_export_root():
+    return cfg.get("HTML_EXPORT_ROOT") or cfg["WEB_ROOT"]
+
 #==========================================
 
 #----------------------------------
@@ -267,6 +597,7 @@ def signal_handler(signal_number, frame):
     run_status = False
 
 #----------------------------------
+# Without HTML_EXPORT the rendered page is printed to stdout
 def main():
     logging.info("Initializing...")
     global run_status
@@ -274,14 +605,26 @@ def main():
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
     hsrv = HomeSrvHtml()
-                
+    exporter = None
+    if cfg.get("HTML_EXPORT"):
+        exporter = HomeSrvExport(get_export_root(), with_json=cfg.get("HTML_EXPORT_JSON", False))
+        if not exporter.is_safe():
+            logging.error("{} wasn't written by homesrv-html - refusing to overwrite it. Set HTML_EXPORT_ROOT to a different directory.".format(os.path.join(exporter.export_root, "index.html")))
+            hsrv.stop()
+            return
+        logging.info("Exporting to {}".format(exporter.export_root))
+
     logging.info("Entering the main loop")
     while run_status:
         hsrv.refresh()
-        print(hsrv.html_data)
-        time.sleep(10)
+        if exporter:
+            exporter.export(hsrv.get_snapshot())
+        else:
+            print(hsrv.html_data)
+        time.sleep(1 if hsrv._is_warming_up() else 10) # pick up the sources as soon as they're initialized
 
     # clean up
+    hsrv.stop()
     logging.info("Exiting")
 
 #---------------------------------------------------
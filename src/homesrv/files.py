@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+File helpers shared by the homesrv services
+(c) 2024 by Christian Rödel
+"""
+
+import os
+import threading
+from homesrv.config import cfg
+
+#----------------------------------
+# Write content (bytes) via a temp file and rename it to fname. The temp file name is unique
+# per process and thread - cache files are shared by homeserver, homesrv-mqtt and homesrvtool.
+def write_atomic(fname, content, mtime=None, makedirs=False):
+    if makedirs:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp_fname = "{}.{}-{}.tmp".format(fname, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_fname, "wb") as file:
+            file.write(content)
+        if mtime:
+            os.utime(tmp_fname, (mtime, mtime))
+        os.replace(tmp_fname, fname)
+    except OSError:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+
+#----------------------------------
+# File name of a cache file: the configured one (cfg[key]) or ~/.cache/homesrv/<name>
+def get_cache_fname(key, name):
+    return os.path.expanduser(cfg.get(key) or os.path.join("~", ".cache", "homesrv", name))
@@ -3,36 +3,188 @@
 Homesrv HTTP Server
 """
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor
+import json
 import logging
 import urllib
 import os
 import shutil
 import signal
 import sys
+import threading
 from homesrv.config import cfg
 from homesrv.HomeSrvHtml import HomeSrvHtml
+from homesrv.metrics import metrics
+from homesrv.webcontent import StaticCache
 
+# Served until the first rendering of index.html is available
+loading_page = b'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><meta http-equiv="refresh" content="2"><title>homesrv</title></head>\n<body><p>Daten werden geladen...</p></body></html>\n'
+
+# =======================
+# HTTP server which handles requests on a bounded pool of worker threads
+class PooledHTTPServer(HTTPServer):
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True, max_workers=8):
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate=bind_and_activate)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="httpd")
+        self.pending = 0  # accepted connections waiting for a free worker
+        self.pending_lock = threading.Lock()
+
+    # ----------------------------------
+    def process_request(self, request, client_address):
+        with self.pending_lock:
+            self.pending += 1
+        self.executor.submit(self._process_request_thread, request, client_address)
+
+    # ----------------------------------
+    def _process_request_thread(self, request, client_address):
+        with self.pending_lock:
+            self.pending -= 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    # ----------------------------------
+    # True if connections are queued because all workers are busy
+    def is_saturated(self):
+        return self.pending > 0
+
+    # ----------------------------------
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
 
 # =======================
 class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # persistent connections
+    timeout = cfg.get("WEB_KEEPALIVE_TIMEOUT", 5) # close idle connections after N seconds
+    disable_nagle_algorithm = True # headers and body are written separately
+
     # ----------------------------------
-    def _set_header(self, status=200, type="html", caching=True):
+    def _set_header(self, status=200, type="html", caching=True, length=0):
         if status == 200:
             self.send_response(200)
             self.send_header('Content-type', 'text/'+type)
+            self.send_header('Content-Length', str(length))
             if caching:
                 self.send_header('Cache-Control', 'max-age=604800')
             else:  
                 self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')  
                 self.send_header('Pragma', 'no-cache')
                 self.send_header('Expires', '0')
+            self._send_connection_header()
+            self.end_headers()
         else:
-            self.send_error(status)
+            self._send_error(status)
+
+    # ----------------------------------
+    # Error response which keeps the connection usable (send_error() always closes it)
+    def _send_error(self, status):
+        content = "{} {}\n".format(status, self.responses.get(status, ("Error",))[0]).encode("utf-8")
+        self.send_response(status)
+        self.send_header('Content-type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self._send_connection_header()
         self.end_headers()
+        self.wfile.write(content)
+
+    # ----------------------------------
+    # Placeholder page while the sources are still initializing; it reloads itself
+    def _send_loading_page(self):
+        self.send_response(503)
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(loading_page)))
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Retry-After', '2')
+        self._send_connection_header()
+        self.end_headers()
+        self.wfile.write(loading_page)
+
+    # ----------------------------------
+    def _send_connection_header(self):
+        # Don't keep idle connections if other clients are waiting for a worker - the
+        # single threaded server would be blocked by an idle connection -> always close
+        if not isinstance(self.server, PooledHTTPServer) or self.server.is_saturated():
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+
+    # ----------------------------------
+    def _send_content(self, content, type="html", caching=True):
+        self._set_header(200, type=type, caching=caching, length=len(content))
+        self.wfile.write(content)
+
+    # ----------------------------------
+    # Send WebContent, answering conditional requests with 304
+    def _send_webcontent(self, item, cache_control):
+        encoding, content, etag = item.get_variant(self.headers.get("Accept-Encoding"))
+        if item.is_not_modified(self.headers.get("If-None-Match"), self.headers.get("If-Modified-Since")):
+            self.send_response(304)
+            content = b''
+        else:
+            self.send_response(200)
+            self.send_header('Content-type', item.content_type)
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+        if item.encodings:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', item.last_modified)
+        self.send_header('Cache-Control', cache_control)
+        self._send_connection_header()
+        self.end_headers()
+        if content:
+            self.wfile.write(content)
+
+    # ----------------------------------
+    # Server-Sent Events: push sections of the page as soon as their content changes
+    def _send_events(self, params):
+        global hsrv
+        global sse_slots
+        if not isinstance(self.server, PooledHTTPServer) or not sse_slots.acquire(blocking=False):
+            logging.warning("Live updates not available - too many clients or server not threaded")
+            self._set_header(503)
+            return
+        try:
+            self.close_connection = True  # endless stream, delimited by closing the connection
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+
+            # Sequence of the snapshot the client shows; in case it's outdated all sections are sent
+            client_sequence = self.headers.get("Last-Event-ID") or params.get("since", [""])[0]
+            snapshot = hsrv.get_snapshot()
+            sequence = None
+            sent = {}
+            if snapshot and client_sequence == str(snapshot.sequence):
+                sequence = snapshot.sequence
+                sent = snapshot.sections
+            while not hsrv.is_stopped():
+                if snapshot and snapshot.sequence != sequence:
+                    for section, snippet in snapshot.sections.items():
+                        if sent.get(section) != snippet:
+                            data = json.dumps({"section": section, "html": snippet})
+                            self.wfile.write("id: {}\nevent: section\ndata: {}\n\n".format(snapshot.sequence, data).encode("utf-8"))
+                    sequence = snapshot.sequence
+                    sent = snapshot.sections
+                snapshot = hsrv.wait_for_snapshot(sequence, timeout=cfg.get("WEB_SSE_KEEPALIVE", 15))
+                if not snapshot:
+                    self.wfile.write(b": keepalive\n\n") # detect disconnected clients
+                    snapshot = hsrv.get_snapshot()
+        except (ConnectionError, OSError) as e:
+            logging.debug("Live update client disconnected: {}".format(e))
+        finally:
+            sse_slots.release()
 
     # ----------------------------------
     def do_GET(self):
         global hsrv
+        global static_cache
         parts = self.path.strip('/').split('?')
         ressource = parts[0]
         if ressource == '':
@@ -41,33 +193,42 @@ class RequestHandler(BaseHTTPRequestHandler):
             params = urllib.parse.parse_qs(parts[1])
         else:
             params = ''
-            if ressource == "index.html":
-                # index.html is dynamically created
-                logging.debug("GET request, dynamic ressource: {}".format(ressource) )  
+        if ressource == "index.html":
+            # index.html is dynamically created; unchanged data is answered with 304
+            logging.debug("GET request, dynamic ressource: {}".format(ressource) )  
+            if not hsrv.is_running(): # no background refresh -> refresh inline
+                hsrv.refresh()
+            snapshot = hsrv.get_snapshot()
+            if snapshot:
+                self._send_webcontent(snapshot.webcontent, cache_control='no-cache') # always revalidate
+            else:
+                self._send_loading_page()
+        elif ressource == "metrics":
+            self._send_content(metrics.render().encode("utf-8"), type="plain; version=0.0.4; charset=utf-8", caching=False)
+        elif ressource == "events":
+            self._send_events(params if params else {})
+        elif ressource == "api" or ressource.startswith("api/"):
+            # JSON API, served from the snapshot
+            if not hsrv.is_running(): # no background refresh -> refresh inline
                 hsrv.refresh()
-                content = hsrv.html_data.encode("utf-8")
-                self._set_header(200, type="html", caching=False)
-                self.wfile.write(content)  
-            else: # read file from file system
-                webroot = os.path.normpath(cfg['WEB_ROOT'])    
-                fname = os.path.normpath(os.path.join(webroot, ressource))
-                # Restrict access to files in/below WEB_ROOT - not outside!
-                if os.path.commonpath([webroot, fname]) == webroot:
-                    logging.debug("GET request, ressource: {}, fname: {}, params: {}".format(ressource, fname, str(params)) )  
-                    try:
-                        with open(fname, 'rb') as file:
-                            content = file.read()
-                            if fname.endswith(".css"):
-                                self._set_header(200, type="css", caching=False)
-                            else:
-                                self._set_header(200, type="html", caching=True)
-                            self.wfile.write(content)  
-                    except IOError as e:
-                        logging.warning("Couldn't open {}".format(e))
-                        self._set_header(404)
+            snapshot = hsrv.get_snapshot()
+            path = urllib.parse.unquote(ressource[4:]).strip('/')
+            item = snapshot.api.get(path) if snapshot else None
+            if item:
+                self._send_webcontent(item, cache_control='no-cache')
+            else:
+                self._set_header(404)
+        else: # static file from web root
+            logging.debug("GET request, ressource: {}, params: {}".format(ressource, str(params)) )  
+            item = static_cache.get(ressource)
+            if item:
+                if ressource.endswith(".css"):
+                    self._send_webcontent(item, cache_control='no-cache') # always revalidate
                 else:
-                    logging.warning("Requested file {} is not in WEB_ROOT - file blocked for securoty reasons-".format(fname))
-                    self._set_header(404)
+                    self._send_webcontent(item, cache_control='max-age=604800')
+            else:
+                logging.warning("Couldn't find ressource {}".format(ressource))
+                self._set_header(404)
 
     # ----------------------------------
     def do_POST(self):
@@ -75,18 +236,21 @@ class RequestHandler(BaseHTTPRequestHandler):
         post_data = self.rfile.read(content_length) # <--- Gets the data itself
         logging.debug("POST request,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n",
                 str(self.path), str(self.headers), post_data.decode('utf-8'))
-        self._set_header()
-        self.wfile.write("POST request for {}".format(self.path).encode('utf-8'))
+        self._send_content("POST request for {}".format(self.path).encode('utf-8'))
 
 #===========================================
 #-------------------------------------------
 def signal_handler(signal_number, frame):
     global httpd
     logging.warning('Received Signal {}. Graceful shutdown initiated.'.format(signal_number))
-    httpd_stop(httpd)
+    if httpd:
+        # shutdown() blocks until serve_forever() returns - so it mustn't run in the serving thread
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
 
 #-------------------------------------------
+# Copies files and returns the list of file names
 def copy_files(src_dir, dest_dir):
+    files = []
     for f in os.listdir(src_dir):
         src_f = os.path.join(src_dir, f)
         dest_f = os.path.join(dest_dir, f)
@@ -95,20 +259,25 @@ def copy_files(src_dir, dest_dir):
             if not os.path.exists(dest_f) or (os.stat(src_f).st_mtime - os.stat(dest_f).st_mtime > 1):
                 logging.info("Copying {} --> {}".format(src_f, dest_f))
                 shutil.copy2(src_f, dest_f)
+            files.append(f)
+    return files
 
 #-------------------------------------------
+# Copy latest templates to HTML directory; returns the template files (relative to web root)
 def initialize_templates():
-    # Copy latest templates to HTML directory
     web_root = cfg["WEB_ROOT"]     # HTML directory
     base_dir = os.path.dirname(__file__) # Base installation directory
     template_dir = os.path.join(base_dir, os.pardir, "homesrv_templates") 
     logging.info("Updating template files {} to web root {}".format(template_dir, web_root))
+    files = []
     if os.path.isdir(web_root):
-        copy_files(template_dir, web_root)
+        files = copy_files(template_dir, web_root)
         os.makedirs(os.path.join(web_root, "images"), exist_ok=True)
-        copy_files(os.path.join(template_dir, "images"), os.path.join(web_root, "images"))
+        for f in copy_files(os.path.join(template_dir, "images"), os.path.join(web_root, "images")):
+            files.append("images/" + f)
     else:
         logging.error("Web root directory doesn't exist: {}".format(web_root))
+    return files
 
 #----------------------
 def httpd_stop():
@@ -122,6 +291,8 @@ def httpd_stop():
 def main():
     global httpd
     global hsrv
+    global static_cache
+    global sse_slots
 
     logging.info('Initializing...')
     httpd = None
@@ -129,12 +300,21 @@ def main():
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
 
-    initialize_templates()
+    templates = initialize_templates()
+    static_cache = StaticCache(cfg["WEB_ROOT"])
+    static_cache.load(templates)
+    sse_slots = threading.BoundedSemaphore(cfg.get("WEB_SSE_CLIENTS", 16))
     hsrv = HomeSrvHtml()
-    hsrv.refresh()
+    if cfg.get("HTML_BACKGROUND_REFRESH", True):
+        hsrv.start() # sources are initialized in the background -> the port is listening right away
 
     logging.info('Starting httpd on {}:{}'.format(cfg['WEB_SERVER'], cfg['WEB_PORT']))
-    httpd = HTTPServer((cfg['WEB_SERVER'], cfg['WEB_PORT']), RequestHandler, bind_and_activate=False)
+    if cfg.get("WEB_THREADED", True):
+        # Live update clients occupy a worker each -> reserve extra workers for them
+        max_workers = cfg.get("WEB_WORKERS", 8) + cfg.get("WEB_SSE_CLIENTS", 16)
+        httpd = PooledHTTPServer((cfg['WEB_SERVER'], cfg['WEB_PORT']), RequestHandler, bind_and_activate=False, max_workers=max_workers)
+    else:
+        httpd = HTTPServer((cfg['WEB_SERVER'], cfg['WEB_PORT']), RequestHandler, bind_and_activate=False)
     try:
         httpd.server_bind()
         httpd.server_activate()
@@ -148,6 +328,8 @@ def main():
     except BaseException as e:
         logging.info('Exception while serving: {}'.format(e))
 
+    httpd_stop()
+    hsrv.stop()
     logging.warning('Exiting.')
 
 #----------------------
@@ -4,12 +4,17 @@ homesrv - server daemon which retrieves data from configured data sources and wr
 (c) 2024 by Christian Rödel 
 """
 
-from datetime import datetime, timedelta
+import functools
+import json
 import logging
-import time
 import signal
+import threading
 from homesrv.config import cfg
-from homesrv.mqtt import mqtt_start, mqtt_stop, mqtt_publish
+from homesrv.files import write_atomic, get_cache_fname
+from homesrv import mqtt
+from homesrv.mqtt import mqtt_start, mqtt_stop, mqtt_publish, mqtt_clear
+from homesrv.metrics import metrics
+from homesrv.scheduler import Scheduler
 from homesrvAPI.awidoAPI import awidoAPI
 from homesrvAPI.openweathermapAPI import openweathermapAPI
 from homesrvAPI.DBtimetableAPI import DBtimetableAPI
@@ -18,99 +23,192 @@ from homesrvAPI.ninaAPI import ninaAPI
 
 #----------------------------------
 def signal_handler(signal_number, frame):
-    global run_status
     logging.warning('Received Signal {}. Graceful shutdown initiated.'.format(signal_number))
-    run_status = False
+    scheduler.stop()
 
+#----------------------------------
+# Refresh interval of a source [s]; MQTT_refesh is the misspelt key of earlier config files
+def get_interval(source, default=None):
+    interval = cfg.get("MQTT_refresh", cfg.get("MQTT_refesh", 300))
+    return cfg.get("MQTT_refresh_" + source, default or interval)
+
+#==========================================
+# Data of the sources: topic -> data
+def get_nina(api_nina, ars):
+    return {"nina/{}".format(ars): api_nina.get_warnings(ars=ars)}
+
+def get_awido(api_awido):
+    return {
+        "waste/{}/current".format(api_awido.title): api_awido.current_collections(),
+        "waste/{}/upcoming".format(api_awido.title): api_awido.upcoming_collections()
+    }
+
+def get_dbstation(api_db, dbstation):
+    data = {"db/{}".format(dbstation.station_id): dbstation.get_station_base_data()}
+    dbstation.refresh(api_db, dt=None)
+    dbtt = dbstation.get_timetable(tt_type="departure")
+    data["db/{}/departure".format(dbstation.station_id)] = dbtt.get_timetable()
+    return data
+
+def get_disruptions(api_disruptions):
+    return {"db/disruptions": api_disruptions.get_disruptions()}
+
+def get_weather(api_weather, location):
+    data = {}
+    for category in ("base", "now", "daytime", "daily"):
+        topic = "weather/{}".format(location) if category == "base" else "weather/{}/{}".format(location, category)
+        data[topic] = api_weather.get_weather(location, category)
+    return data
+
+def get_stats():
+    # statistics: upstream requests, latencies, cache hits
+    return {"stats": metrics.get_stats()}
+
+#----------------------------------
+# Job: retrieve the data of a source and publish its topics; returns the data
+def publish_source(get_data, *args):
+    data = get_data(*args)
+    for topic, payload in data.items():
+        mqtt_publish(topic, payload)
+    return data
+
+#----------------------------------
+# Per train topics db/<station_id>/departure/<train_id>: only new and changed trains are published.
+# The topics of trains which left the board are deleted (empty retained message) and the
+# trains are announced in db/<station_id>/departure/removed. The published train ids are saved
+# to MQTT_departures_file, so the topics of trains which left while the daemon was down are deleted, too.
+departures = {}  # station_id -> (re-sync generation, {train_id: departure}) of the last publication
+departures_lock = threading.Lock()
+
+def publish_departure_deltas(station_id, timetable):
+    generation, previous = departures.get(station_id, (None, {}))
+    resync = generation != mqtt.resync_generation # everything is published again
+    current = {item["train_id"]: item for item in timetable}
+    base_topic = "db/{}/departure".format(station_id)
+    for train_id, item in current.items():
+        if resync or previous.get(train_id) != item:
+            mqtt_publish("{}/{}".format(base_topic, train_id), item)
+    removed = [train_id for train_id in previous if train_id not in current]
+    for train_id in removed:
+        mqtt_clear("{}/{}".format(base_topic, train_id))
+    if removed:
+        mqtt_publish(base_topic + "/removed", removed, force=True, retain=False)
+    with departures_lock:
+        departures[station_id] = (mqtt.resync_generation, current)
+        if current.keys() != previous.keys():
+            save_departures()
+
+def get_departures_fname():
+    return get_cache_fname("MQTT_departures_file", "mqtt-departures.json")
+
+# Train ids of the last run; they are compared to the first board after the start
+def load_departures():
+    fname = get_departures_fname()
+    try:
+        with open(fname, "r", encoding="utf-8") as file:
+            items = json.load(file)
+        for station_id, train_ids in items:
+            departures[station_id] = (None, {train_id: None for train_id in train_ids})
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, TypeError) as e:
+        logging.warning("Couldn't read {}: {}".format(fname, str(e)))
+
+# Called with departures_lock held
+def save_departures():
+    fname = get_departures_fname()
+    items = [[station_id, list(trains)] for station_id, (_, trains) in departures.items()] # pairs keep the type of station_id
+    try:
+        write_atomic(fname, json.dumps(items).encode("utf-8"), makedirs=True)
+    except OSError as e:
+        logging.warning("Couldn't write {}: {}".format(fname, str(e)))
+
+def publish_dbstation(api_db, dbstation):
+    data = publish_source(get_dbstation, api_db, dbstation)
+    if cfg.get("MQTT_db_departure_delta", True):
+        publish_departure_deltas(dbstation.station_id, data["db/{}/departure".format(dbstation.station_id)])
+    return data
+
+#==========================================
+# Commands via <base>/cmd - as text or JSON:
+#   refresh <source> [arg]  refresh a source right away, bypassing cached data (e.g. "refresh db 8004158")
+#   query <source> [arg]    publish the data of a source to <base>/reply/<source>[/<arg>]
+#   {"cmd": "query", "source": "weather", "arg": "Mycity", "reply_to": "automation/weather"}  (reply_to is below <base>)
+# Sources: nina <ars>, waste, db <station_id>, disruptions, weather <location>, stats
+source_aliases = {"awido": "waste", "disruptions": "db/disruptions"}
+
+def on_command(msg):
+    try:
+        if msg.lstrip().startswith("{"):
+            cmd = json.loads(msg)
+        else:
+            parts = msg.split(maxsplit=2)
+            cmd = {"cmd": parts[0], "source": parts[1], "arg": parts[2] if len(parts) > 2 else None}
+        command = cmd["cmd"]
+        source = source_aliases.get(cmd["source"], cmd["source"])
+    except (ValueError, KeyError, IndexError, TypeError):
+        logging.warning("Invalid command: {}".format(msg))
+        return
+    name = "{}/{}".format(source, cmd["arg"]) if cmd.get("arg") else source
+
+    if command == "refresh":
+        found = scheduler.trigger(name, force=True)
+    elif command == "query":
+        reply_to = cmd.get("reply_to") or "reply/" + name
+        def reply(data):
+            if data is None:
+                data = {"error": "Couldn't retrieve data for {}".format(name)}
+            mqtt_publish(reply_to, data, force=True, retain=False)
+        found = scheduler.trigger(name, callback=reply)
+    else:
+        logging.warning("Unknown command: {}".format(command))
+        return
+    if not found:
+        logging.warning("Unknown source: {}".format(name))
 
 #==========================================
 def main():
-    global run_status
-    run_status = True 
+    global scheduler
+    # sources are refreshed concurrently; each job publishes its topics as soon as its data is available
+    scheduler = Scheduler(stagger=cfg.get("MQTT_stagger", 2), max_workers=cfg.get("MQTT_workers", 4), timeout=cfg.get("MQTT_job_timeout", 60))
 
     # Initialization
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
 
     logging.info("Initializing...")
-    last_update = None
-    api_awido = None
-    api_weather = None
-    api_db = None
-    api_disruptions = None
-    api_nina = None
+    mqttclient = mqtt_start(on_command=on_command) # one persistent broker connection for all topics - connects while the APIs initialize
+    if cfg.get("MQTT_enable_nina"):
+        logging.info("Initializing ninaAPI")
+        api_nina = ninaAPI()
+        for location in api_nina.locations:
+            scheduler.add("nina/{}".format(location["ars"]), publish_source, (get_nina, api_nina, location["ars"]), get_interval("nina"))
     if cfg.get("MQTT_enable_awido"):
         logging.info("Initializing awidoAPI")
         api_awido = awidoAPI()
+        scheduler.add("waste", publish_source, (get_awido, api_awido), get_interval("awido"), invalidate=api_awido.invalidate)
     if cfg.get("MQTT_enable_db"):
         logging.info("Initializing DB API")
         api_db = DBtimetableAPI()
         api_disruptions = DBdisruptionsAPI()
+        if cfg.get("MQTT_db_departure_delta", True):
+            load_departures()
+        for dbstation in api_db.get_dbstations(): # changes are refreshed every DB_refresh_changes seconds
+            scheduler.add("db/{}".format(dbstation.station_id), publish_dbstation, (api_db, dbstation), get_interval("db", cfg.get("DB_refresh_changes", 60)), invalidate=dbstation.invalidate)
+        scheduler.add("db/disruptions", publish_source, (get_disruptions, api_disruptions), get_interval("disruptions", cfg.get("DB_refresh_disruptions", 600)), invalidate=api_disruptions.invalidate)
     if cfg.get("MQTT_enable_weather"):
         logging.info("Initializing openweathermapAPI")
         api_weather = openweathermapAPI()
-    if cfg.get("MQTT_enable_nina"):
-        logging.info("Initializing ninaAPI")
-        api_nina = ninaAPI()
+        for location in api_weather.get_locations():
+            scheduler.add("weather/{}".format(location), publish_source, (get_weather, api_weather, location), get_interval("weather"), invalidate=functools.partial(api_weather.invalidate, location))
+    scheduler.add("stats", publish_source, (get_stats,), get_interval("stats"))
   
     logging.info("Entering the run loop")
-    while run_status:
-        now = datetime.now()
-        if not last_update or now > last_update + timedelta(seconds=cfg.get("MQTT_refresh", 300)):
-            last_update = now
-            logging.info("Refreshing data")
-
-            # nina
-            if api_nina:
-                for location in api_nina.locations:
-                    topic = "nina/{}".format(location["ars"])
-                    data = api_nina.get_warnings(ars=location["ars"])     
-                    mqtt_publish(topic, data)
-
-            # waste
-            if api_awido:
-                topic = "waste/{}/current".format(api_awido.title)
-                data = api_awido.current_collections()
-                mqtt_publish(topic, data)
-                topic = "waste/{}/upcoming".format(api_awido.title)
-                data = api_awido.upcoming_collections()
-                mqtt_publish(topic, data)
-
-            # Deutsche Bahn
-            if api_db:
-                for dbstation in api_db.get_dbstations():
-                    topic = "db/{}".format(dbstation.station_id)
-                    data = dbstation.get_station_base_data() 
-                    mqtt_publish(topic, data)
-                    topic = "db/{}/departure".format(dbstation.station_id)
-                    dbstation.refresh(api_db, dt=None)
-                    dbtt = dbstation.get_timetable(tt_type="departure")
-                    data = dbtt.get_timetable()
-                    mqtt_publish(topic, data)
-
-                topic = "db/disruptions"
-                data = api_disruptions.get_disruptions()
-                mqtt_publish(topic, data)
-
-            # weather
-            if api_weather:
-                for location in api_weather.get_locations():
-                    topic = "weather/{}".format(location)
-                    data = api_weather.get_weather(location, 'base')
-                    mqtt_publish(topic, data)
-                    topic = "weather/{}/now".format(location)
-                    data = api_weather.get_weather(location, 'now')
-                    mqtt_publish(topic, data)
-                    topic = "weather/{}/daytime".format(location)
-                    data = api_weather.get_weather(location, 'daytime')
-                    mqtt_publish(topic, data)
-                    topic = "weather/{}/daily".format(location)
-                    data = api_weather.get_weather(location, 'daily')
-                    mqtt_publish(topic, data)
-
-        time.sleep(10)
+    scheduler.run()
 
     # clean up
+    if mqttclient:
+        mqtt_stop(mqttclient)
     logging.info("Exiting")
  
 #---------------------------------------------------
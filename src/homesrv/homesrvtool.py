@@ -49,7 +49,7 @@ def interactive_oid_selection(api: awidoAPI):
 # Deutsche Bahn
 def search_dbstation(api: DBtimetableAPI):
     station_name = input("DB station name you want to search: ")
-    stations = api.search_stations_by_name(station_name)
+    stations = api.search_stations_by_name(station_name, limit=30) # best matches first
     print("Name: Id")
     for name, id in stations:
         print("{}: {}".format(name, id))
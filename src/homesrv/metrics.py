@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+In-process metrics (counters, gauges, histograms) with Prometheus text exposition
+(c) 2024 by Christian Rödel
+"""
+
+import threading
+import time
+
+default_buckets = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#================================================
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}        # name -> (type, help)
+        self.values = {}      # counters and gauges: name -> {labels: value}
+        self.histograms = {}  # name -> {labels: [bucket counts..., sum, count]}
+        self.buckets = {}     # name -> bucket bounds
+
+    #----------------------------------
+    def inc(self, name, labels=None, value=1, help=""):
+        key = self._labels(labels)
+        with self.lock:
+            self.meta.setdefault(name, ("counter", help))
+            series = self.values.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    #----------------------------------
+    def set(self, name, value, labels=None, help=""):
+        key = self._labels(labels)
+        with self.lock:
+            self.meta.setdefault(name, ("gauge", help))
+            self.values.setdefault(name, {})[key] = value
+
+    #----------------------------------
+    def observe(self, name, value, labels=None, help="", buckets=default_buckets):
+        key = self._labels(labels)
+        with self.lock:
+            self.meta.setdefault(name, ("histogram", help))
+            bounds = self.buckets.setdefault(name, buckets)
+            series = self.histograms.setdefault(name, {})
+            data = series.get(key)
+            if not data:
+                data = series[key] = [0] * (len(bounds) + 2)
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    #----------------------------------
+    # Context manager which observes the duration of the enclosed block [s]
+    def timer(self, name, labels=None, help=""):
+        return _Timer(self, name, labels, help)
+
+    #----------------------------------
+    # Prometheus text exposition format
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (type, help) in sorted(self.meta.items()):
+                if help:
+                    lines.append("# HELP {} {}".format(name, help))
+                lines.append("# TYPE {} {}".format(name, type))
+                if type == "histogram":
+                    bounds = self.buckets[name]
+                    for key, data in self.histograms.get(name, {}).items():
+                        for i, bound in enumerate(bounds):
+                            lines.append("{}_bucket{} {}".format(name, self._format_labels(key + (("le", str(bound)),)), data[i]))
+                        lines.append("{}_bucket{} {}".format(name, self._format_labels(key + (("le", "+Inf"),)), data[-1]))
+                        lines.append("{}_sum{} {}".format(name, self._format_labels(key), data[-2]))
+                        lines.append("{}_count{} {}".format(name, self._format_labels(key), data[-1]))
+                else:
+                    for key, value in self.values.get(name, {}).items():
+                        lines.append("{}{} {}".format(name, self._format_labels(key), value))
+        return "\n".join(lines) + "\n"
+
+    #----------------------------------
+    # All metrics as a dict (e.g. for publishing via MQTT)
+    def get_stats(self):
+        stats = {}
+        with self.lock:
+            for name, series in self.values.items():
+                stats[name] = [dict(key, value=value) for key, value in series.items()]
+            for name, series in self.histograms.items():
+                stats[name] = [dict(key, count=data[-1], sum=round(data[-2], 6)) for key, data in series.items()]
+        return stats
+
+    #----------------------------------
+    def _labels(self, labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+    #----------------------------------
+    def _format_labels(self, key):
+        if not key:
+            return ""
+        items = []
+        for k, v in key:
+            v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+            items.append('{}="{}"'.format(k, v))
+        return "{" + ",".join(items) + "}"
+
+#================================================
+class _Timer:
+    def __init__(self, metrics, name, labels, help):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.help = help
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.monotonic() - self.start, self.labels, help=self.help)
+        return False
+
+#================================================
+metrics = Metrics()
+
+#----------------------------------
+# Record a request to an upstream API; start is a time.monotonic() timestamp
+def observe_upstream(upstream, endpoint, start, error=False):
+    labels = {"upstream": upstream, "endpoint": endpoint}
+    metrics.inc("homesrv_upstream_requests_total", labels, help="Requests to upstream APIs")
+    if error:
+        metrics.inc("homesrv_upstream_errors_total", labels, help="Failed requests to upstream APIs")
+    metrics.observe("homesrv_upstream_request_seconds", time.monotonic() - start, labels, help="Latency of upstream API requests")
+
+#----------------------------------
+# Record whether a refresh gate could serve cached data (hit) or had to refresh (miss)
+def count_cache(gate, hit):
+    metrics.inc("homesrv_cache_requests_total", {"gate": gate, "result": "hit" if hit else "miss"}, help="Cache lookups per refresh gate")
@@ -4,26 +4,59 @@ MQTT client base implemantation
 (c) 2024 by Christian Rödel 
 """
 from homesrv.config import cfg
+from homesrv.files import write_atomic, get_cache_fname
+from homesrv.metrics import metrics
+from datetime import datetime, timedelta
+import base64
+import functools
+import hashlib
 import json
 import logging
+import os
+import threading
+import time
+import timeit
 
 try:
     import paho.mqtt.client as mqttcl
     import paho.mqtt.publish as publish
 except Exception as e:
     logging.warning("MQTT not set up because of: {}".format(e))
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
     
+client = None  # long-lived client of the daemon (see mqtt_start) - used by mqtt_publish
+command_handler = None  # called with the payload of messages to <base>/cmd
+published = {}  # topic -> hash of the last published payload
+published_lock = threading.Lock()
+last_resync = time.monotonic()
+resync_generation = 0  # incremented on every re-sync
+spool = {}  # topic -> (payload, retain): latest payload which couldn't be published
+spool_lock = threading.Lock()
+
 # ============ MQTT ================
 def on_mqtt_connect(mqttclient, userdata, flags, rc, prop):
     if rc == 0:
         logging.info("Connected to MQTT broker")
+        mqtt_resync() # the broker might have lost retained messages
+        flush_spool(mqttclient)
+        if userdata or command_handler: # (re-)subscribe on every connect - subscriptions don't survive a reconnect
+            mqttclient.subscribe(cfg["MQTT_base_topic"]+"/cmd", qos=0)
     else:
         logging.error("Error while connecting to MQTT broker: rc={}".format(rc))
 
-def on_mqtt_disconnect(mqttclient, userdata, rc):
+def on_mqtt_disconnect(mqttclient, userdata, flags, rc, prop):
     logging.warning("MQTT broker disconnected: rc={}".format(rc))
   
-def on_mqtt_subscribe(mqttclient, userdata, mid, granted_qos):
+def on_mqtt_subscribe(mqttclient, userdata, mid, rc_list, prop):
     logging.info("MQTT broker subscribed to mid {}".format(mid))
 
 def on_mqtt_message(mqttclient, userdata, message):
@@ -31,47 +64,243 @@ def on_mqtt_message(mqttclient, userdata, message):
         msg = message.payload.decode("utf-8")
         topic = message.topic.split("/")
         logging.info("Received topic {}, msg {}".format(topic, msg))
+        if command_handler and topic[-1] == "cmd":
+            command_handler(msg)
     except Exception as e:
         logging.warning("Error while handling MQTT message: {}".format(str(e)))
 
-def mqtt_start( api=None ): 
+# Start a persistent client. The connection is established and re-established (after
+# broker restarts, network issues) by the client's network thread - this never blocks. 
+# on_command is called (on the network thread) with the payload of messages to <base>/cmd
+def mqtt_start( api=None, on_command=None ): 
+    global client
+    global command_handler
+    if cfg['MQTT_disable']:
+        return None
     try: 
-        client = mqttcl.Client(mqttcl.CallbackAPIVersion.VERSION2)
-        client.user_data_set(api) # register API instance
+        mqttclient = mqttcl.Client(mqttcl.CallbackAPIVersion.VERSION2)
+        mqttclient.user_data_set(api) # register API instance
         if cfg['MQTT_login']:
-            client.username_pw_set(cfg['MQTT_login'], cfg['MQTT_password']) 
-        client.on_connect = on_mqtt_connect
-        client.on_disconnect = on_mqtt_disconnect
-        client.on_message = on_mqtt_message
-        client.on_subscribe = on_mqtt_subscribe
-        client.connect(cfg['MQTT_server'], cfg['MQTT_port'], keepalive = 60) 
-        if api:
-            client.subscribe(cfg["MQTT_base_topic"]+"/cmd", qos=0)
-            client.loop_start()
-            logging.info('MQTT server started')
-        return client
+            mqttclient.username_pw_set(cfg['MQTT_login'], cfg['MQTT_password']) 
+        mqttclient.on_connect = on_mqtt_connect
+        mqttclient.on_disconnect = on_mqtt_disconnect
+        mqttclient.on_message = on_mqtt_message
+        mqttclient.on_subscribe = on_mqtt_subscribe
+        mqttclient.reconnect_delay_set(min_delay=1, max_delay=cfg.get("MQTT_reconnect_max_delay", 120))
+        mqttclient.max_queued_messages_set(cfg.get("MQTT_max_queued", 1000)) # messages waiting for the broker 
+        mqttclient.connect_async(cfg['MQTT_server'], cfg['MQTT_port'], keepalive = 60) 
+        command_handler = on_command
+        load_spool()
+        mqttclient.loop_start()
+        client = mqttclient
+        logging.info('MQTT client started')
+        return mqttclient
     except Exception as e:
         logging.warning("Couldn't start MQTT: {}".format(str(e)))
 
-def mqtt_stop(client):
+def mqtt_stop(mqttclient):
+    global client
     try: 
-        client.loop_stop()
-        logging.info('MQTT server stopped')
+        mqttclient.disconnect()
+        mqttclient.loop_stop()
+        logging.info('MQTT client stopped')
     except Exception as e:
         logging.warning("Couldn't stop MQTT: {}".format(str(e)))
+    if mqttclient is client:
+        client = None
+
+# Forget the published payloads -> all topics are published again
+def mqtt_resync():
+    global last_resync
+    global resync_generation
+    with published_lock:
+        published.clear()
+        last_resync = time.monotonic()
+        resync_generation += 1
 
-def mqtt_publish(topic, data):
+# Delete a (retained) topic by publishing an empty message; its payload hash is dropped
+def mqtt_clear(topic):
+    mqtt_publish(topic, "", force=True, retain=True)
+    with published_lock:
+        published.pop(cfg["MQTT_base_topic"] + "/" + topic, None)
+
+# Publish data (dicts and lists as JSON) as retained message. Payloads which didn't change since
+# they were last published are skipped; all topics are published again every MQTT_resync seconds.
+# With a started client the message is only queued for the client's network thread; otherwise
+# a single message connection is used.
+def mqtt_publish(topic, data, force=False, retain=None):
+    if isinstance(data, (str, bytes)):
+        payload = data
+    else:
+        payload = get_serializer(topic)(data)
     topic = cfg["MQTT_base_topic"] + "/" + topic
-    if isinstance(data, (dict, list)):
-        payload = json.dumps(data)
+    digest = hashlib.sha1(payload if isinstance(payload, bytes) else payload.encode("utf-8")).digest()
+    if time.monotonic() - last_resync > cfg.get("MQTT_resync", 3600):
+        logging.info("MQTT re-sync: publishing all topics")
+        mqtt_resync()
+    if not force and published.get(topic) == digest:
+        metrics.inc("homesrv_mqtt_messages_total", {"result": "unchanged"}, help="MQTT messages by result")
+        return
+
+    if retain is None:
+        retain = cfg.get("MQTT_retain", True)
     if cfg['MQTT_disable']: # Don't do anything - just logg
         logging.info("- {}: {}".format(topic, payload))
+    elif client:
+        logging.debug("- {}: {}".format(topic, payload))
+        if not client.is_connected(): # keep the latest payload until the broker is back
+            spool_message(topic, payload, retain)
+            return
+        info = client.publish(topic, payload=payload, qos=cfg.get("MQTT_qos", 0), retain=retain)
+        if info.rc != mqttcl.MQTT_ERR_SUCCESS:
+            logging.warning("Couldn't queue MQTT message for {}: {}".format(topic, mqttcl.error_string(info.rc)))
+            spool_message(topic, payload, retain)
+            return
     else:  
         auth = None
         if cfg['MQTT_login']:
             auth = { 'username': cfg['MQTT_login'], 'password': cfg['MQTT_password'] }  
         logging.debug("- {}: {}".format(topic, payload))
         try:
-            publish.single(topic, payload=payload, hostname=cfg['MQTT_server'], port=cfg['MQTT_port'], auth=auth)
+            publish.single(topic, payload=payload, retain=retain, hostname=cfg['MQTT_server'], port=cfg['MQTT_port'], auth=auth)
         except Exception as e:
             logging.error("Could't send MQTT command: {}".format(str(e)))
+            metrics.inc("homesrv_mqtt_messages_total", {"result": "error"}, help="MQTT messages by result")
+            return
+    with published_lock:
+        published[topic] = digest
+    metrics.inc("homesrv_mqtt_messages_total", {"result": "published"}, help="MQTT messages by result")
+
+# ============ Serializers ================
+# Compact JSON (no whitespace, UTF-8) - using orjson if it's installed
+def serialize_json(data):
+    if orjson:
+        return orjson.dumps(data, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False, default=str)
+
+def serialize_msgpack(data):
+    return msgpack.packb(data, default=str, use_bin_type=True)
+
+# Topics (relative to the base topic) starting with one of the MQTT_msgpack_topics prefixes
+# are published as MessagePack; all others as JSON
+@functools.lru_cache(maxsize=256)
+def get_serializer(topic):
+    for prefix in cfg.get("MQTT_msgpack_topics") or []:
+        if topic.startswith(prefix):
+            if msgpack:
+                return serialize_msgpack
+            logging.warning("msgpack isn't installed - publishing {} as JSON".format(topic))
+            break
+    return serialize_json
+
+# ============ Spool ================
+# Messages which can't be published while the broker is unreachable are kept in a spool:
+# only the latest payload per topic (max. MQTT_spool_max topics). The spool is saved to
+# MQTT_spool_file, so it survives restarts, and flushed as soon as the broker is connected.
+def get_spool_fname():
+    return get_cache_fname("MQTT_spool_file", "mqtt-spool.json")
+
+def spool_message(topic, payload, retain):
+    with spool_lock:
+        if topic not in spool and len(spool) >= cfg.get("MQTT_spool_max", 500):
+            logging.warning("MQTT spool is full - dropping message for {}".format(topic))
+            metrics.inc("homesrv_mqtt_spool_dropped_total", help="MQTT messages dropped because the spool was full")
+            return
+        spool[topic] = (payload, retain)
+        _save_spool()
+    metrics.inc("homesrv_mqtt_messages_total", {"result": "spooled"}, help="MQTT messages by result")
+    if client and client.is_connected(): # connected in the meantime -> the spool might have been flushed already
+        flush_spool(client)
+
+def flush_spool(mqttclient):
+    with spool_lock:
+        if not spool:
+            return
+        items = list(spool.items())
+        spool.clear()
+        flushed = 0
+        for topic, (payload, retain) in items:
+            info = mqttclient.publish(topic, payload=payload, qos=cfg.get("MQTT_qos", 0), retain=retain)
+            if info.rc == mqttcl.MQTT_ERR_SUCCESS:
+                flushed += 1
+            else: # disconnected again
+                spool[topic] = (payload, retain)
+        _save_spool()
+    logging.info("MQTT spool flushed: {} messages".format(flushed))
+    metrics.inc("homesrv_mqtt_spool_flushed_total", value=flushed, help="Spooled MQTT messages which have been published")
+
+def load_spool():
+    fname = get_spool_fname()
+    try:
+        with open(fname, "r", encoding="utf-8") as file:
+            items = json.load(file)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logging.warning("Couldn't read MQTT spool {}: {}".format(fname, str(e)))
+        return
+    with spool_lock:
+        for item in items:
+            payload = base64.b64decode(item["payload"]) if item.get("base64") else item["payload"]
+            spool.setdefault(item["topic"], (payload, item.get("retain", True)))
+        metrics.set("homesrv_mqtt_spool_depth", len(spool), help="Topics waiting in the MQTT spool")
+    logging.info("MQTT spool loaded: {} messages".format(len(items)))
+
+# Write the spool atomically - called with spool_lock held
+def _save_spool():
+    metrics.set("homesrv_mqtt_spool_depth", len(spool), help="Topics waiting in the MQTT spool")
+    fname = get_spool_fname()
+    try:
+        if not spool:
+            if os.path.exists(fname):
+                os.remove(fname)
+            return
+        items = []
+        for topic, (payload, retain) in spool.items():
+            if isinstance(payload, bytes):
+                items.append({"topic": topic, "payload": base64.b64encode(payload).decode("ascii"), "base64": True, "retain": retain})
+            else:
+                items.append({"topic": topic, "payload": payload, "retain": retain})
+        write_atomic(fname, json.dumps(items).encode("utf-8"), makedirs=True)
+    except OSError as e:
+        logging.warning("Couldn't write MQTT spool {}: {}".format(fname, str(e)))
+
+#-------------------------------
+# Benchmark of the serializers with payloads of a typical cycle: bytes on the wire and encode time
+def main():
+    now = datetime.now()
+    departures = []
+    for i in range(40):
+        departures.append({"train_id": "-{}-2401011200-{}".format(1000000000000000000 + i, i % 12 + 1), "train": "S {}".format(i % 8 + 1),
+                           "path": "München-Pasing|München Hbf|München Ost|Ebersberg", "from_to": "Ebersberg(Oberbay)",
+                           "date": (now + timedelta(minutes=3 * i)).strftime("%d.%m.%Y %H:%M"), "platform": str(i % 10 + 1),
+                           "status": "", "message": "Verspätung aus vorheriger Fahrt" if i % 7 == 0 else None})
+    daily = []
+    for i in range(8):
+        daily.append({"dt": int(now.timestamp()) + i * 86400, "dt_txt": (now + timedelta(days=i)).strftime("%a %d.%m.%Y"),
+                      "sunrise_txt": "07:12", "sunset_txt": "18:45", "temp_min": 4.2 + i, "temp_max": 12.7 + i, "humidity": 71,
+                      "pressure": 1017, "wind_speed_kmh": 14, "wind_direction": "SW", "description": "leichter Regen", "icon": "10d.png",
+                      "precipitation": 0.8, "precipitation_txt": "80%", "rain_txt": "1.2 mm", "uv_index_txt": "mäßig (3.1)"})
+    hourly = [dict(item, dt_txt=(now + timedelta(hours=i)).strftime("%H:%M")) for i, item in enumerate(daily * 6)]
+    payloads = {"db/8004158/departure": departures, "db/8000261/departure": departures, "weather/Mycity/daily": daily,
+                "weather/Mycity/hourly": hourly, "waste/home/upcoming": [{"date": "Mo 01.01.2024", "waste_type": "Restmülltonne 40-240 L",
+                "site": "Hauptstraße", "location": "Fürstenfeldbruck", "district": ""}] * 6}
+
+    candidates = [("json.dumps (previous)", json.dumps),
+                  ("json compact", lambda data: json.dumps(data, separators=(",", ":"), ensure_ascii=False, default=str))]
+    if orjson:
+        candidates.append(("orjson", serialize_json))
+    if msgpack:
+        candidates.append(("msgpack", serialize_msgpack))
+    else:
+        print("(msgpack isn't installed)")
+    number = 200
+    print("Serializing {} topics per cycle".format(len(payloads)))
+    for name, func in candidates:
+        size = sum(len(p if isinstance(p, bytes) else p.encode("utf-8")) for p in (func(data) for data in payloads.values()))
+        duration = min(timeit.repeat(lambda: [func(data) for data in payloads.values()], number=number, repeat=3)) / number
+        print("  {:24s} {:8d} bytes  {:8.1f} us/cycle".format(name, size, duration * 1e6))
+
+#---------------------------------------------------
+if __name__ == '__main__':
+    main()
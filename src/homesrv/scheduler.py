@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Scheduler for periodic jobs with individual intervals
+(c) 2024 by Christian Rödel
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from homesrv.metrics import metrics
+
+#================================================
+class Job:
+    def __init__(self, name, func, args, interval, timeout=None, invalidate=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.invalidate = invalidate  # drops cached data, called before forced runs
+        self.interval = interval  # [s]
+        self.timeout = timeout    # deadline of a run [s] - a run which takes longer is abandoned at the next due time
+        self.due = None  # time.monotonic() timestamp of the next run
+        self.running = False # a run is in progress
+        self.started = None  # time.monotonic() timestamp of the current run
+        self.run = 0         # number of the current run - results of abandoned runs are dropped
+        self.callbacks = []  # called with the result of the current/next run
+        self.force_pending = False  # a forced run was triggered while the job was running
+
+#================================================
+# Jobs are kept in a priority queue ordered by their due time; the scheduler
+# sleeps until the next job is due (or it is stopped).
+# With max_workers the jobs run concurrently on a pool of worker threads. A job whose
+# previous run is still in progress is skipped - unless the run exceeded its deadline (e.g. a
+# hanging upstream API): then it's abandoned, a new run is started and its late result is dropped.
+# The thread of an abandoned run can't be stopped, it occupies a worker until it returns.
+class Scheduler:
+    def __init__(self, stagger=0, max_workers=None, timeout=None):
+        self.stagger = stagger  # delay between the first runs of consecutively added jobs [s]
+        self.timeout = timeout  # default deadline of a job run [s]
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job") if max_workers else None
+        self.futures = set()  # submitted job runs which haven't finished yet
+        self.queue = []  # heap of (due, sequence, job)
+        self.jobs = {}   # name -> job
+        self.sequence = itertools.count()  # tie breaker for jobs with the same due time
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+
+    #----------------------------------
+    def add(self, name, func, args=(), interval=300, timeout=None, invalidate=None):
+        with self.lock:
+            job = Job(name, func, args, interval, timeout or self.timeout, invalidate)
+            job.due = time.monotonic() + len(self.jobs) * self.stagger  # spread the first runs
+            self.jobs[name] = job
+            heapq.heappush(self.queue, (job.due, next(self.sequence), job))
+        self.wakeup.set()
+        return job
+
+    #----------------------------------
+    # Run a job right away (out of schedule); callback(result) is called after the run.
+    # With force, the job's cached data is invalidated before.
+    # Triggers which arrive while the job is running are coalesced into the current run - forced
+    # triggers into one run with invalidated data right after the current run.
+    # Returns False for unknown jobs.
+    def trigger(self, name, callback=None, force=False):
+        with self.lock:
+            job = self.jobs.get(name)
+            if not job:
+                return False
+            if callback:
+                job.callbacks.append(callback)
+            if job.running:
+                if force: # the current run may have used cached data
+                    job.force_pending = True
+                    logging.info("Job {} is already running - forced run queued".format(name))
+                else:
+                    logging.info("Job {} is already running - trigger coalesced".format(name))
+                return True
+            if force and job.invalidate:
+                job.invalidate()
+            job.due = time.monotonic()  # the previous queue entry becomes obsolete
+            heapq.heappush(self.queue, (job.due, next(self.sequence), job))
+        self.wakeup.set()
+        return True
+
+    #----------------------------------
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    #----------------------------------
+    # Run due jobs until stopped
+    def run(self):
+        while not self.stopped:
+            job = self._next_due()
+            if job:
+                self._dispatch(job)
+        if self.executor:
+            with self.lock:
+                futures = list(self.futures)
+            for future in futures: # cancel_futures of shutdown() requires python 3.9
+                future.cancel()
+            self.executor.shutdown(wait=False)
+
+    #----------------------------------
+    # Returns the next due job - or None if woken up before (job added, stop)
+    def _next_due(self):
+        with self.lock:
+            while self.queue and self.queue[0][0] != self.queue[0][2].due: # drop obsolete entries (triggered jobs)
+                heapq.heappop(self.queue)
+            if self.queue:
+                timeout = self.queue[0][0] - time.monotonic()
+                if timeout <= 0:
+                    job = heapq.heappop(self.queue)[2]
+                    job.due = max(job.due + job.interval, time.monotonic())  # fixed rate, no catch-up bursts
+                    heapq.heappush(self.queue, (job.due, next(self.sequence), job))
+                    if job.running:
+                        if not job.timeout or time.monotonic() - job.started <= job.timeout:
+                            self._skip(job)
+                            return None
+                        self._abandon(job)
+                    job.running = True
+                    job.started = time.monotonic()
+                    job.run += 1
+                    return job
+            else:
+                timeout = None
+            self.wakeup.clear()
+        self.wakeup.wait(timeout)
+        return None
+
+    #----------------------------------
+    def _dispatch(self, job):
+        if self.executor:
+            future = self.executor.submit(self._run_job, job, job.run)
+            with self.lock:
+                self.futures.add(future)
+            future.add_done_callback(self._discard_future)
+        else:
+            self._run_job(job, job.run)
+
+    #----------------------------------
+    def _discard_future(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+    #----------------------------------
+    def _skip(self, job):
+        logging.info("Job {} is still running - skipped".format(job.name))
+        metrics.inc("homesrv_jobs_skipped_total", {"job": job.name}, help="Job runs skipped because the previous run was still in progress")
+
+    #----------------------------------
+    # Called with the lock held
+    def _abandon(self, job):
+        logging.warning("Job {} is stuck for {:.0f}s - starting a new run".format(job.name, time.monotonic() - job.started))
+        metrics.inc("homesrv_jobs_abandoned_total", {"job": job.name}, help="Job runs abandoned because they exceeded their deadline")
+
+    #----------------------------------
+    def _run_job(self, job, run):
+        logging.debug("Running job {}".format(job.name))
+        start = time.monotonic()
+        result = None
+        try:
+            result = job.func(*job.args)
+        except Exception as e:
+            logging.error("Error while running job {}: {}".format(job.name, str(e)))
+            metrics.inc("homesrv_job_errors_total", {"job": job.name}, help="Job runs which failed")
+        duration = time.monotonic() - start
+        metrics.observe("homesrv_job_seconds", duration, {"job": job.name}, help="Duration of job runs")
+        if job.timeout and duration > job.timeout:
+            logging.warning("Job {} took {:.1f}s (deadline {}s)".format(job.name, duration, job.timeout))
+        with self.lock:
+            if run != job.run:
+                logging.warning("Job {}: dropped the result of an abandoned run".format(job.name))
+                return
+            job.running = False
+            callbacks = job.callbacks
+            job.callbacks = []
+            if job.force_pending:
+                job.force_pending = False
+                if job.invalidate:
+                    job.invalidate()
+                job.due = time.monotonic()  # the previous queue entry becomes obsolete
+                heapq.heappush(self.queue, (job.due, next(self.sequence), job))
+                self.wakeup.set()
+        for callback in callbacks:
+            try:
+                callback(result)
+            except Exception as e:
+                logging.error("Error in callback of job {}: {}".format(job.name, str(e)))
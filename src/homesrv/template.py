@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Compiled html templates with %%Placeholder%% slots
+(c) 2024 by Christian Rödel
+"""
+
+import hashlib
+import logging
+import os
+import re
+
+placeholder_re = re.compile(r"%%(\w+)%%")
+
+#================================================
+# Template which is parsed once into literal segments and placeholder slots.
+# It's recompiled only if the file (or the file in use) changes.
+class HtmlTemplate:
+    def __init__(self, fnames, placeholders):
+        self.fnames = fnames  # candidate files - the first readable one is used
+        self.placeholders = placeholders  # known placeholder names
+        self.fname = None
+        self.mtime = None
+        self.digest = None  # sha1 of the template source
+        self.segments = []  # literals at even, placeholder names at odd positions
+
+    #----------------------------------
+    # Returns True if a compiled template is available
+    def refresh(self):
+        for fname in self.fnames:
+            try:
+                mtime = os.stat(fname).st_mtime
+            except OSError:
+                continue
+            if fname == self.fname and mtime == self.mtime:
+                return True
+            try:
+                with open(fname, "r", encoding="utf-8") as file:
+                    data = file.read()
+            except Exception as ex:
+                logging.debug("Couldn't read {}: {}".format(fname, ex))
+                continue
+            if data:
+                self._compile(fname, data)
+                self.fname = fname
+                self.mtime = mtime
+                return True
+        if not self.fname:
+            logging.critical("Couldn't read any template of {}".format(self.fnames))
+        return self.fname is not None
+
+    #----------------------------------
+    # Render the template with a dict of placeholder -> html snippet
+    def render(self, values):
+        parts = self.segments.copy()
+        for i in range(1, len(parts), 2):
+            parts[i] = values.get(parts[i], "")
+        return "".join(parts)
+
+    #----------------------------------
+    def _compile(self, fname, data):
+        self.segments = placeholder_re.split(data)
+        self.digest = hashlib.sha1(data.encode("utf-8")).digest()
+        used = set(self.segments[1::2])
+        for name in sorted(used - set(self.placeholders)):
+            logging.warning("Template {}: unknown placeholder %%{}%% - it will be rendered empty".format(fname, name))
+        for name in self.placeholders:
+            if name not in used:
+                logging.info("Template {}: placeholder %%{}%% is not used".format(fname, name))
+        logging.info("Template {} compiled: {} placeholders".format(fname, len(self.segments) // 2))
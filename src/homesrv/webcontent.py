@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+In-memory web content (static files, rendered pages) incl. validators for conditional requests
+(c) 2024 by Christian Rödel
+"""
+
+import functools
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+content_types = {
+    ".html": "text/html; charset=utf-8",
+    ".css":  "text/css; charset=utf-8",
+    ".js":   "application/javascript; charset=utf-8",
+    ".json": "application/json",
+    ".png":  "image/png",
+    ".jpg":  "image/jpeg",
+    ".ico":  "image/x-icon",
+    ".svg":  "image/svg+xml",
+}
+
+compressible_types = ("text/", "application/javascript", "application/json", "image/svg+xml", "image/x-icon")
+min_compress_size = 256 # don't bother compressing tiny ressources
+
+#----------------------------------
+def get_content_type(fname):
+    ext = os.path.splitext(fname)[1].lower()
+    return content_types.get(ext) or mimetypes.guess_type(fname)[0] or "application/octet-stream"
+
+#----------------------------------
+# Returns precompressed variants {encoding: bytes}; variants which don't save space are dropped
+def compress(content):
+    encodings = {}
+    if len(content) >= min_compress_size:
+        if brotli:
+            encodings["br"] = brotli.compress(content, quality=11)
+        encodings["gzip"] = gzip.compress(content, compresslevel=9, mtime=0)
+    return {k: v for k, v in encodings.items() if len(v) < len(content)}
+
+#----------------------------------
+# Parse Accept-Encoding header into {coding: qvalue}
+@functools.lru_cache(maxsize=64)
+def parse_accept_encoding(header):
+    accepted = {}
+    for part in header.split(","):
+        items = part.split(";")
+        coding = items[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in items[1:]:
+            k, _, v = param.partition("=")
+            if k.strip().lower() == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+#================================================
+# Representation of a web ressource held in memory
+class WebContent:
+    def __init__(self, content, content_type, mtime=None, etag=None, compressible=None):
+        self.content = content
+        self.content_type = content_type
+        self.mtime = mtime if mtime else time.time()
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        if etag:
+            self.etag = etag
+        else:
+            self.etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+        if compressible is None:
+            compressible = content_type.startswith(compressible_types)
+        self.encodings = compress(content) if compressible else {}  # encoding -> compressed bytes
+        self.etags = {self.etag} | {self._get_etag(k) for k in self.encodings}  # validators of all variants
+
+    #----------------------------------
+    # Returns (encoding, content, etag) of the best variant for the given Accept-Encoding header
+    def get_variant(self, accept_encoding=None):
+        if accept_encoding and self.encodings:
+            accepted = parse_accept_encoding(accept_encoding)
+            for encoding in ("br", "gzip"):
+                if encoding in self.encodings and accepted.get(encoding, accepted.get("*", 0)) > 0:
+                    return encoding, self.encodings[encoding], self._get_etag(encoding)
+        return None, self.content, self.etag
+
+    #----------------------------------
+    # Each encoding is a separate representation and gets its own ETag
+    def _get_etag(self, encoding):
+        return '{}-{}"'.format(self.etag[:-1], encoding)
+
+    #----------------------------------
+    # Check validators of a conditional request
+    def is_not_modified(self, if_none_match=None, if_modified_since=None):
+        if if_none_match: # If-None-Match takes precedence over If-Modified-Since
+            for tag in if_none_match.split(","):
+                tag = tag.strip()
+                if tag == "*" or tag in self.etags or "W/"+tag in self.etags or tag.replace("W/", "", 1) in self.etags:  # weak comparison
+                    return True
+            return False
+        if if_modified_since:
+            try:
+                return int(self.mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+        return False
+
+#================================================
+# Cache for static files below the web root; entries are reloaded if their mtime changes
+class StaticCache:
+    def __init__(self, web_root, max_size=1024*1024, check_interval=2):
+        self.web_root = os.path.normpath(web_root)
+        self.max_size = max_size  # don't keep larger files in memory
+        self.check_interval = check_interval  # stat() cached files at most every N seconds
+        self.files = {}  # ressource -> [WebContent, fname, last_check]
+
+    #----------------------------------
+    # Preload a list of ressources (path relative to web root)
+    def load(self, ressources):
+        for ressource in ressources:
+            self.get(ressource)
+        logging.info("Static cache: {} files loaded".format(len(self.files)))
+
+    #----------------------------------
+    # Returns WebContent for a ressource or None if it doesn't exist
+    def get(self, ressource):
+        now = time.time()
+        entry = self.files.get(ressource)
+        if entry:
+            item, fname, last_check = entry
+            if now - last_check < self.check_interval:
+                return item
+        else:
+            fname = os.path.normpath(os.path.join(self.web_root, ressource))
+            # Restrict access to files in/below WEB_ROOT - not outside!
+            if os.path.commonpath([self.web_root, fname]) != self.web_root:
+                logging.warning("Requested file {} is not in WEB_ROOT - file blocked for security reasons".format(fname))
+                return None
+            item = None
+
+        try:
+            st = os.stat(fname)
+            if item and item.mtime == st.st_mtime and len(item.content) == st.st_size:
+                entry[2] = now
+                return item
+            with open(fname, 'rb') as file:
+                content = file.read()
+        except (IOError, OSError) as e:
+            logging.debug("Couldn't open {}".format(e))
+            self.files.pop(ressource, None)
+            return None
+
+        logging.debug("Static cache: loaded {}".format(fname))
+        item = WebContent(content, get_content_type(fname), mtime=st.st_mtime)
+        if len(content) <= self.max_size:
+            self.files[ressource] = [item, fname, now]
+        return item
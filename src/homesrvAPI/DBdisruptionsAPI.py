@@ -6,7 +6,9 @@ DBdisruptions main class
 
 import logging
 from homesrv.config import cfg
+from homesrv.metrics import observe_upstream, count_cache
 import requests
+import time
 from datetime import datetime, timedelta
 
 
@@ -17,6 +19,12 @@ class DBdisruptionsAPI:
     def __init__(self):
         self.disruptions = None
         self.disruptions_date = None
+        self.generation = 0  # incremented whenever disruptions change
+
+    #---------------------------
+    # Force a refresh on the next access
+    def invalidate(self):
+        self.disruptions_date = None
 
     #---------------------------
     def get_disruptions(self):
@@ -48,15 +56,20 @@ class DBdisruptionsAPI:
     #---------------------------
     def _refresh_disruptions(self):
         dt_now = datetime.now() 
-        if not self.disruptions_date or self.disruptions_date < dt_now-timedelta(seconds=cfg["DB_refresh_disruptions"]): 
+        stale = not self.disruptions_date or self.disruptions_date < dt_now-timedelta(seconds=cfg["DB_refresh_disruptions"])
+        count_cache("db_disruptions", not stale)
+        if stale: 
             logging.info( "Refreshing DB disruptions" )
             json = self._do_API_call()
             if json and json.get("disruptions"):
+                if json.get("disruptions") != self.disruptions:
+                    self.generation += 1
                 self.disruptions = json.get("disruptions")
                 self.disruptions_date = dt_now
 
     #---------------------------
     def _do_API_call(self):
+        start = time.monotonic()
         try:
             url = cfg["DB_disruptions_base_url"]
             response = requests.get( url, timeout=10 )
@@ -65,9 +78,11 @@ class DBdisruptionsAPI:
             logging.error( "Couldn't request disruptions API: {} Exception {:s}".format(url, str(err)) )
         else:
             if response.status_code == 200:
+                observe_upstream("db_disruptions", "disruptions", start)
                 return response.json()
             else:
                 logging.error( "Error while requesting disruptions API: {:s} -> {:d} {:s}".format( url, response.status_code, response.reason) )
+        observe_upstream("db_disruptions", "disruptions", start, error=True)
         return None  
 
 #===============================================================
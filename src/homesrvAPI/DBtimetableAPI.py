@@ -9,10 +9,15 @@ import logging
 FORMAT = '[%(levelname)s] %(message)s'
 logging.basicConfig(format=FORMAT, level=logging.INFO)
 
+import json
 import requests
+import threading
+import time
 import xmltodict
 from homesrv.config import cfg
-from homesrvAPI.DBtimetableHelpers import DBtimetable, DBtrain_stop
+from homesrv.files import write_atomic, get_cache_fname
+from homesrv.metrics import observe_upstream, count_cache
+from homesrvAPI.DBtimetableHelpers import DBtimetable, DBtrain_stop, DBstation_index
 from datetime import datetime, timedelta
 
 
@@ -23,22 +28,30 @@ class DBtimetableAPI:
     def __init__(self):
         self.station_map = None
         self.station_map_date = None
+        self.station_map_validators = {}  # ETag / Last-Modified of the downloaded station list
+        self.station_map_lock = threading.Lock()
+        self.station_map_refreshing = False  # a background refresh is in progress
+        self.station_index = None  # search index of the current station_map
         self.dbstations = []
         self.headers = {
             "DB-Api-Key": cfg.get("DB_client_secret"),
             "DB-Client-Id": cfg.get("DB_client_id"),
             "accept": "application/xml"
         }
+        self._load_station_map()
         self._init_stations()
         
     #---------------------------
-    def search_stations_by_name(self, substring):
+    # Case and umlaut insensitive search; returns [[name, eva], ...] - best matches first
+    def search_stations_by_name(self, substring, limit=None):
         self._refresh_station_map()
-        stations = []
-        for eva, name in self.station_map.items():
-            if substring in name:
-                stations.append( [name, eva] )
-        return stations    
+        with self.station_map_lock:
+            if not self.station_index or self.station_index.station_map is not self.station_map: # (re)build once per station list
+                start = time.monotonic()
+                self.station_index = DBstation_index(self.station_map)
+                logging.info( "Station search index built in {:.0f}ms".format((time.monotonic()-start)*1000) )
+            station_index = self.station_index
+        return station_index.search(substring, limit=limit)
 
     #---------------------------
     def get_dbstations(self):
@@ -63,37 +76,122 @@ class DBtimetableAPI:
             logging.error( "Unknown station_id {}".format(station_id) )
             
     #---------------------------
+    # The station list is cached on disk. A stale list is still served while it's refreshed
+    # in the background; only without any list the download is done right away.
     def _refresh_station_map(self):
         dt_now = datetime.now() 
-        if not self.station_map_date or self.station_map_date < dt_now-timedelta(hours=24): 
+        stale = not self.station_map_date or self.station_map_date < dt_now-timedelta(seconds=cfg.get("DB_refresh_station_map", 86400))
+        count_cache("db_station_map", not stale)
+        if stale: 
+            if self.station_map:
+                with self.station_map_lock:
+                    if self.station_map_refreshing:
+                        return
+                    self.station_map_refreshing = True
+                threading.Thread(target=self._download_station_map, name="db-stations", daemon=True).start()
+            else:
+                self._download_station_map()
+
+    #---------------------------
+    # Download the station list - as conditional request if the list is already known
+    def _download_station_map(self):
+        try:
             logging.info( "Refreshing station list from API. This will take a few seconds..." )
-            self.station_map = {}
-            json = self._do_API_call( "station/*" )
-            if json and json.get("stations"):
-                for item in json["stations"]["station"]:
-                    name = item["@name"]
-                    eva = item["@eva"]
-                    self.station_map[eva] = name
+            headers = {}
+            if self.station_map:
+                if self.station_map_validators.get("etag"):
+                    headers["If-None-Match"] = self.station_map_validators["etag"]
+                if self.station_map_validators.get("last_modified"):
+                    headers["If-Modified-Since"] = self.station_map_validators["last_modified"]
+            response = self._request( "station/*", headers=headers )
+            dt_now = datetime.now() 
+            if response is None:
+                logging.error( "Error while refreshing station list!" )
+            elif response.status_code == 304:
+                logging.info( "Station list is unchanged" )
                 self.station_map_date = dt_now
+                self._save_station_map()
             else:
-                logging.error( "Error while refreshing station list!" )
+                response_json = xmltodict.parse(response.text)
+                if response_json and response_json.get("stations"):
+                    station_map = {}
+                    for item in response_json["stations"]["station"]:
+                        name = item["@name"]
+                        eva = item["@eva"]
+                        station_map[eva] = name
+                    self.station_map = station_map # replaced as a whole - readers never see a partial map
+                    self.station_map_validators = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+                    self.station_map_date = dt_now
+                    self._save_station_map()
+                else:
+                    logging.error( "Error while refreshing station list!" )
+            if self.station_map is None:
+                self.station_map = {}
+        finally:
+            self.station_map_refreshing = False
+
+    #---------------------------
+    def _get_station_map_fname(self):
+        return get_cache_fname("DB_station_cache_file", "db-stations.json")
+
+    #---------------------------
+    def _load_station_map(self):
+        start = time.monotonic()
+        fname = self._get_station_map_fname()
+        try:
+            with open(fname, "r", encoding="utf-8") as file:
+                data = json.load(file)
+            self.station_map = data["stations"]
+            self.station_map_validators = {"etag": data.get("etag"), "last_modified": data.get("last_modified")}
+            self.station_map_date = datetime.fromisoformat(data["date"])
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning( "Couldn't read station list cache {}: {}".format(fname, str(e)) )
+            return
+        logging.info( "Station list loaded from {}: {} stations in {:.0f}ms".format(fname, len(self.station_map), (time.monotonic()-start)*1000) )
+
+    #---------------------------
+    # Write the station list cache atomically
+    def _save_station_map(self):
+        fname = self._get_station_map_fname()
+        data = {
+            "date": self.station_map_date.isoformat(),
+            "etag": self.station_map_validators.get("etag"),
+            "last_modified": self.station_map_validators.get("last_modified"),
+            "stations": self.station_map
+        }
+        try:
+            write_atomic(fname, json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), makedirs=True)
+        except OSError as e:
+            logging.warning( "Couldn't write station list cache {}: {}".format(fname, str(e)) )
 
     #---------------------------
     def _do_API_call(self, path):
+        response = self._request(path)
+        if response is not None:
+            return xmltodict.parse(response.text)
+        return None  
+
+    #---------------------------
+    # Returns the response (200 or 304) - or None on errors
+    def _request(self, path, headers=None):
+        start = time.monotonic()
+        endpoint = path.split("/")[0]
         try:
             url = cfg["DB_timetable_base_url"] + path
-            response = requests.get( url, headers=self.headers, timeout=10 )
+            response = requests.get( url, headers={**self.headers, **(headers or {})}, timeout=10 )
 
         except requests.exceptions.RequestException as err:
             logging.error( "Couldn't request DB API: {} Exception {:s}".format(url, str(err)) )
         else:
-            if response.status_code == 200:
-                response_json = xmltodict.parse(response.text)
-                return response_json
+            if response.status_code in (200, 304):
+                observe_upstream("db_timetable", endpoint, start)
+                return response
             else:
                 logging.error( "Error while requesting DB API: {:s} -> {:d} {:s}".format( url, response.status_code, response.reason) )
-        return None  
-
+        observe_upstream("db_timetable", endpoint, start, error=True)
+        return None
 
 #===============================================================
 # Representation of a station and the related, cached train schedules
@@ -108,6 +206,12 @@ class DBstation:
         self.schedule_date = None
         self.schedule_refresh_date = None
         self.change_refresh_date = None
+        self.generation = 0  # incremented whenever consolidated data is rebuilt
+
+    #---------------------------
+    # Force a refresh of the changes on the next refresh
+    def invalidate(self):
+        self.change_refresh_date = None
 
     #---------------------------
     def refresh(self, api: DBtimetableAPI, dt: datetime=None):
@@ -121,7 +225,9 @@ class DBstation:
             self.schedule_date = dt   
 
         # refresh main schedule
-        if not self.schedule_refresh_date or self.schedule_refresh_date < dt_now-timedelta(seconds=cfg["DB_refresh_schedule"]):     
+        stale = not self.schedule_refresh_date or self.schedule_refresh_date < dt_now-timedelta(seconds=cfg["DB_refresh_schedule"])
+        count_cache("db_schedule", not stale)
+        if stale:     
             logging.info( "Refreshing schedule for station_id {}".format(self.station_id) )
             self.schedule.clear()      
             self._get_schedule(api, dt=dt)
@@ -129,11 +235,22 @@ class DBstation:
             self.schedule_refresh_date = dt_now
             self.change_refresh_date = None # force refresh of changes to avoid
         # refresh changes
-        if not self.change_refresh_date or self.change_refresh_date < dt_now-timedelta(seconds=cfg["DB_refresh_changes"]): 
+        stale = not self.change_refresh_date or self.change_refresh_date < dt_now-timedelta(seconds=cfg["DB_refresh_changes"])
+        count_cache("db_changes", not stale)
+        if stale: 
             logging.info( "Refreshing changes for station_id {}".format(self.station_id) )
             self.changes.clear()      
             self._get_changes(api)
             self._apply_changes()
+            self.change_refresh_date = dt_now
+            self.generation += 1
+
+    #---------------------------
+    def get_station_base_data(self):
+        data = {}
+        data["station_id"] = self.station_id
+        data["station_name"] = self.station_name
+        return data
 
     #---------------------------
     def get_timetable(self, tt_type="departure", dt: datetime=None):
@@ -179,14 +296,6 @@ class DBstation:
                 schedules.append(item)
         return schedules
 
-    #---------------------------
-    def _search_changes(self, train_id):
-        schedules = []
-        for item in self.changes:
-            if item.base["train_id"] == train_id:
-                schedules.append(item)
-        return schedules
-
     #---------------------------
     def _get_schedule(self, api: DBtimetableAPI, dt: datetime=None):
         if not dt:
@@ -244,10 +353,14 @@ class DBstation:
 
         url = "fchg/{}".format(self.station_id)
         json = api._do_API_call( url )
-        timetable = json["timetable"]
+        timetable = json.get("timetable") if json else None
 
-        if timetable:
+        if timetable and timetable.get("s"):
             # iterate over all trains in timetable    
+            if isinstance(timetable["s"], dict): 
+                # if timetable["s"] is not a list but consists of single item
+                timetable["s"] = [timetable["s"]]
+
             for item in timetable["s"]: 
                 train = DBtrain_stop()
                 train.base["train_id"] = item.get("@id")
@@ -293,10 +406,15 @@ class DBstation:
                 
 
     #---------------------------
+    # Merge schedule and changes into a fresh consolidated view - the cached schedule stays untouched
     def _apply_changes(self):
-        self.consolidated = self.schedule.copy() # create a fresh copy of schedule
-        for schedule_item in self.consolidated:
-            for change_item in self._search_changes(schedule_item.base["train_id"]):
+        changes = {} # train_id -> change items
+        for change_item in self.changes:
+            changes.setdefault(change_item.base["train_id"], []).append(change_item)
+        consolidated = []
+        for schedule_item in self.schedule:
+            schedule_item = schedule_item.copy()
+            for change_item in changes.get(schedule_item.base["train_id"], []):
                 for p, v in change_item.arrival.items():
                     sched_p = p.split('_')[1]
                     if schedule_item.arrival.get(sched_p) != v: # just set changed_* param, if value has changed    
@@ -305,8 +423,9 @@ class DBstation:
                     sched_p = p.split('_')[1]
                     if schedule_item.departure.get(sched_p) != v: # just set changed_* param, if value has changed    
                         schedule_item.departure[p] = v     
-                schedule_item.messages = change_item.messages.copy()
-
+                schedule_item.messages = [msg.copy() for msg in change_item.messages]
+            consolidated.append(schedule_item)
+        self.consolidated = consolidated
 
 #===============================================================
 # Some test and demo code
@@ -4,11 +4,104 @@ DBtimetableAPI Helper classes
 (c) 2024 by Christian Rödel 
 """
 
+import bisect
+import heapq
+import re
+import unicodedata
 import logging
 #FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
 FORMAT = '[%(levelname)s] %(message)s'
 logging.basicConfig(format=FORMAT, level=logging.INFO)
 
+umlauts = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue"})
+non_alnum = re.compile(r"[^0-9a-z]+")
+
+#---------------------------
+# Normalized variants of a station name: case-folded, with umlauts as ae/oe/ue and with
+# accents stripped ("München-Pasing" -> "muenchen pasing", "munchen pasing")
+def normalize_station_name(name):
+    text = name.casefold() # also ß -> ss
+    variants = []
+    for variant in (text.translate(umlauts), text):
+        variant = "".join(c for c in unicodedata.normalize("NFKD", variant) if not unicodedata.combining(c))
+        variant = non_alnum.sub(" ", variant).strip()
+        if variant not in variants:
+            variants.append(variant)
+    return variants
+
+#===============================================================
+# Search index over the station list; built once per station list.
+# Query words with 3+ characters are looked up via trigrams and match anywhere in the name,
+# shorter words match the beginning of a word. All query words have to match.
+class DBstation_index:
+    #---------------------------
+    def __init__(self, station_map):
+        self.station_map = station_map  # eva -> name the index was built from
+        self.stations = []    # (name, eva, normalized variants)
+        self.trigrams = {}    # trigram -> set of station indexes
+        self.words = {}       # word -> set of station indexes
+        for eva, name in sorted(station_map.items(), key=lambda item: (len(item[1]), item[1])): # shorter names rank higher
+            idx = len(self.stations)
+            variants = normalize_station_name(name)
+            self.stations.append((name, eva, variants))
+            for variant in variants:
+                for word in variant.split():
+                    self.words.setdefault(word, set()).add(idx)
+                for i in range(len(variant) - 2):
+                    self.trigrams.setdefault(variant[i:i+3], set()).add(idx)
+        self.sorted_words = sorted(self.words)
+
+    #---------------------------
+    # Returns [[name, eva], ...] - best matches first
+    def search(self, query, limit=None):
+        query_variants = normalize_station_name(query)
+        candidates = set()
+        for variant in query_variants:
+            matches = self._match(variant)
+            if matches:
+                candidates |= matches
+        rank = lambda idx: self._rank(idx, query_variants)
+        ranked = heapq.nsmallest(limit, candidates, key=rank) if limit else sorted(candidates, key=rank)
+        return [[self.stations[idx][0], self.stations[idx][1]] for idx in ranked]
+
+    #---------------------------
+    # Indexes of the stations matching all words of a normalized query
+    def _match(self, query):
+        matches = None
+        for word in sorted(query.split(), key=len, reverse=True): # longer words are more selective
+            if len(word) >= 3:
+                found = matches # only stations which matched the previous words
+                for i in range(len(word) - 2):
+                    postings = self.trigrams.get(word[i:i+3], set())
+                    found = postings if found is None else found & postings
+                    if not found:
+                        break
+                found = {idx for idx in found if any(word in variant for variant in self.stations[idx][2])}
+            else:
+                found = set()
+                pos = bisect.bisect_left(self.sorted_words, word)
+                while pos < len(self.sorted_words) and self.sorted_words[pos].startswith(word):
+                    found |= self.words[self.sorted_words[pos]]
+                    pos += 1
+                if matches is not None:
+                    found &= matches
+            matches = found
+            if not matches:
+                return None
+        return matches
+
+    #---------------------------
+    # Exact name, name prefix, word prefix, anywhere in the name; then shorter names first
+    def _rank(self, idx, query_variants):
+        variants = self.stations[idx][2]
+        rank = 3
+        for query in query_variants:
+            for variant in variants:
+                if variant.startswith(query):
+                    return (0 if variant == query else 1, idx)
+                if rank > 2 and (" " + query) in (" " + variant):
+                    rank = 2
+        return (rank, idx)
 
 #===============================================================
 # Represents a timetable
@@ -100,6 +193,16 @@ class DBtrain_stop:
         self.arrival = {}
         self.departure = {}
         self.messages = []
+
+    #---------------------------
+    # Independent copy - the fields only hold strings, so copying the dicts is sufficient
+    def copy(self):
+        train = DBtrain_stop()
+        train.base = self.base.copy()
+        train.arrival = self.arrival.copy()
+        train.departure = self.departure.copy()
+        train.messages = [msg.copy() for msg in self.messages]
+        return train
    
     #---------------------------
     def get_arrival(self):
@@ -10,7 +10,9 @@ import locale
 from io import StringIO
 from datetime import datetime, timedelta
 import logging
+import time
 from homesrv.config import cfg
+from homesrv.metrics import observe_upstream, count_cache
 
 #================================================
 class awidoAPI:
@@ -29,6 +31,7 @@ class awidoAPI:
     def __init__(self):
         self.awido_data = []
         self.refresh_date = None
+        self.generation = 0  # incremented whenever awido_data changes
         self.region = cfg.get("awido_region")
         self.oid = cfg.get("awido_oid")
         self.waste_types = cfg.get("awido_waste_types")
@@ -46,6 +49,11 @@ class awidoAPI:
     def set_waste_types(self, waste_types):
         self.waste_types = waste_types
 
+    #-----------------------------------
+    # Force a refresh on the next access
+    def invalidate(self):
+        self.refresh_date = None
+
     #-----------------------------------
     def all_collections(self): 
         self._refresh_awido_data()
@@ -99,8 +107,11 @@ class awidoAPI:
             return
         
         now = datetime.now()
-        if not self.refresh_date or self.refresh_date < now-timedelta(hours=1): 
+        stale = not self.refresh_date or self.refresh_date < now-timedelta(hours=1)
+        count_cache("awido", not stale)
+        if stale: 
             logging.info("Refreshing awido info")
+            previous = self.awido_data.copy()
             self.awido_data.clear()           
             years = [now.year]
             if now.month >= 11: # Starting in Nov -> retrieve data for next year
@@ -108,7 +119,7 @@ class awidoAPI:
             
             for year in years:
                 url = "Customer/{}/KalenderCSV.aspx?oid={}&jahr={}&fraktionen=".format(self.region, self.oid, year)    
-                data_orig = self._do_API_call( url )
+                data_orig = self._do_API_call( url, endpoint="calendar" )
                 if data_orig:
                     self.current_data = []
                     string_io = StringIO(data_orig.content.decode('ISO-8859-1'))
@@ -124,11 +135,13 @@ class awidoAPI:
                     self.refresh_date = now    
                 else:
                     logging.error( "Couldn't refresh awido data for {}".format(year) )
+            if self.awido_data != previous:
+                self.generation += 1
 
     #-----------------------------------
     def retrieve_places(self, region):
         url = "WebServices/Awido.Service.svc/getPlaces/client={}".format(region)
-        data = self._do_API_call( url )
+        data = self._do_API_call( url, endpoint="places" )
         if data:
             places = {}
             for row in data.json():
@@ -141,7 +154,7 @@ class awidoAPI:
     #-----------------------------------
     def retrieve_streets(self, region, place_key):
         url = "WebServices/Awido.Service.svc/getGroupedStreets/{}?client={}".format(place_key, region)
-        data = self._do_API_call( url )
+        data = self._do_API_call( url, endpoint="streets" )
         if data:            
             streets = {}
             for row in data.json():
@@ -154,7 +167,7 @@ class awidoAPI:
     #-----------------------------------
     def retrieve_street_parts(self, region, street_key):
         url = "WebServices/Awido.Service.svc/getStreetAddons/{}?client={}".format(street_key, region)
-        data = self._do_API_call( url )
+        data = self._do_API_call( url, endpoint="street_parts" )
         if data:
             street_parts = {}
             for row in data.json():
@@ -165,7 +178,8 @@ class awidoAPI:
             return None            
         
     #---------------------------
-    def _do_API_call( self, url ):
+    def _do_API_call( self, url, endpoint="other" ):
+        start = time.monotonic()
         url = self.base_url + url
         try:
             response = requests.get(url, timeout=5)
@@ -173,8 +187,10 @@ class awidoAPI:
             logging.error( "Couldn't request awido API: {} Exception {:s}".format(url, str(err)) )
         else:
             if response.status_code == 200:
+                observe_upstream("awido", endpoint, start)
                 return response
             else:
                 logging.error( "Error while requesting awido API: {:s} -> {:d} {:s}".format( url, response.status_code, response.reason) )
+        observe_upstream("awido", endpoint, start, error=True)
         return None  
 
@@ -4,7 +4,9 @@ Retrieve NINA warnings
 
 import requests
 import logging
+import time
 from homesrv.config import cfg
+from homesrv.metrics import observe_upstream
 
 #================================================
 class ninaAPI:
@@ -14,6 +16,8 @@ class ninaAPI:
     #---------------------------
     def __init__(self):
         self.locations=[] 
+        self.warnings = {}  # ars -> last retrieved warnings
+        self.generations = {}  # ars -> counter, incremented whenever the warnings change
         self._refresh_ars_list()
         self._init_locations()
         
@@ -58,7 +62,7 @@ class ninaAPI:
             # get dashboard data
             ars_district = data["ars"][:5] + "0000000" # Data is available on "Kreisebene" only -> replace last 7 digits with 0
             url = self.nina_base_url + "/dashboard/" + ars_district + ".json"
-            warnings = self._do_API_call( url )
+            warnings = self._do_API_call( url, endpoint="dashboard" )
             
             if warnings:
                 for warning in warnings:
@@ -70,17 +74,26 @@ class ninaAPI:
                     # get details for the warning id
                     id = warning["payload"]["id"]
                     url = self.nina_base_url + "/warnings/" + id + ".json"
-                    warning_details = self._do_API_call( url )            
+                    warning_details = self._do_API_call( url, endpoint="warnings" )            
                     if warning_details:
                         item["headline"] = warning_details["info"][0]["headline"]
                         item["description"] = warning_details["info"][0]["description"]
                     
                     data["warnings"].append(item)                       
+
+            if data != self.warnings.get(ars):
+                self.warnings[ars] = data
+                self.generations[ars] = self.generations.get(ars, 0) + 1
         return data      
+
+    #-----------------------------------
+    # data version of the warnings for an ars
+    def get_generation(self, ars):
+        return self.generations.get(ars, 0)
     
     #-----------------------------------
     def _refresh_ars_list(self):
-        ars_list = self._do_API_call( self.ars_url )
+        ars_list = self._do_API_call( self.ars_url, endpoint="ars_list" )
         if ars_list:
             self.ars_list = ars_list.get("daten") 
         else:    
@@ -94,16 +107,19 @@ class ninaAPI:
                 self.add_location(ars=ars)        
 
     #---------------------------
-    def _do_API_call(self, url):
+    def _do_API_call(self, url, endpoint="other"):
+        start = time.monotonic()
         try:
             response = requests.get( url, timeout=3 )
         except requests.exceptions.RequestException as err:
             logging.error( "Couldn't request NINA API: {} Exception {:s}".format(url, str(err)) )
         else:
             if response.status_code == 200:
+                observe_upstream("nina", endpoint, start)
                 return response.json()
             else:
                 logging.error( "Error while requesting NINA API: {:s} -> {:d} {:s}".format( url, response.status_code, response.reason) )
+        observe_upstream("nina", endpoint, start, error=True)
 
 #===============================================================
 # Some test and demo code
@@ -5,8 +5,10 @@ API class which retrieves data from openweathermap.org
 """
 
 from homesrv.config import cfg
+from homesrv.metrics import observe_upstream, count_cache
 import requests
 import locale
+import time
 from datetime import datetime, timedelta
 import logging
 
@@ -18,6 +20,8 @@ class openweathermapAPI:
     #-----------------------------------
     def __init__(self):
         self.weather = {}
+        self.generations = {}  # location -> counter, incremented on every refresh
+        self.invalidated = set()  # locations which are refreshed on the next access
         self._read_config()
         locale.setlocale(locale.LC_ALL, "")     
 
@@ -51,6 +55,11 @@ class openweathermapAPI:
         else:
             logging.error( "Location not found :-(" ) 
 
+    #-----------------------------------
+    # data version of a location
+    def get_generation(self, location):
+        return self.generations.get(location, 0)
+
     #-----------------------------------
     # get list of locations
     def get_locations(self):
@@ -84,7 +93,7 @@ class openweathermapAPI:
     def get_weather(self, location, categogy=None):
         self.refresh_location(location)
         wdata = self._prettify_weather(location)
-        if categogy:
+        if categogy and wdata:
             ret = {}
             for k, v in wdata.items():
                 if k == categogy:
@@ -98,6 +107,11 @@ class openweathermapAPI:
         for location, _ in self.weather.items():
             self.refresh_location(location)
 
+    #------------------------------------------------------------------        
+    # Force a refresh of a location on the next access
+    def invalidate(self, location):
+        self.invalidated.add(location)
+
     #------------------------------------------------------------------        
     # refresh weather info for a location
     def refresh_location(self, location): 
@@ -105,11 +119,17 @@ class openweathermapAPI:
         item = self.weather.get(location)
         if item:
             last_refresh = item.get("last_refresh")  
-            if not last_refresh or now > last_refresh + timedelta(seconds=300):    
+            stale = not last_refresh or now > last_refresh + timedelta(seconds=300) or location in self.invalidated
+            count_cache("weather", not stale)
+            if stale:    
+                self.invalidated.discard(location)
                 logging.info("Refreshing weather info for {}".format(location))
-                self.weather[location] = self._request_openweathermap(item["lat"], item["lon"])                
-                self.weather[location]["last_refresh"] = now
-                self.weather[location]['location'] = location
+                data = self._request_openweathermap(item["lat"], item["lon"])
+                if data: # keep previous data if request failed
+                    self.weather[location] = data
+                    self.weather[location]["last_refresh"] = now
+                    self.weather[location]['location'] = location
+                    self.generations[location] = self.generations.get(location, 0) + 1
         else:    
             logging.error( "Undefined location: {}".format(location) )
 
@@ -137,15 +157,18 @@ class openweathermapAPI:
     #-----------------------------------
     def _request_openweathermap(self, lat, lon):    # get weather info from OpenWeatherMap API
         payload = { 'lat': lat, 'lon': lon, 'units': cfg['weather_units'], 'lang': cfg['weather_lang'], 'appid': cfg['weather_api_key'] } 
+        start = time.monotonic()
         try:
             response = requests.get(self.base_url, payload, timeout=3)
         except requests.exceptions.RequestException as err:
             logging.error( "Couldn't request openweathermap API: Exception {:s}".format(str(err)) )
         else:
             if response.status_code == 200:
+                observe_upstream("openweathermap", "onecall", start)
                 return response.json()
             else:
                 logging.error( "Error while requesting openweathermap API: {:s} -> {:d} {:s}".format( str(payload), response.status_code, response.reason) )
+        observe_upstream("openweathermap", "onecall", start, error=True)
 
     #-----------------------------------
     def _search_location(self, city, country=None, limit=1):
@@ -155,11 +178,14 @@ class openweathermapAPI:
             location = city 
 
         payload = { 'q': location, 'appid': cfg['weather_api_key'], 'limit': limit }
+        start = time.monotonic()
         try:
             response = requests.get(self.geo_url, payload, timeout=3)
         except requests.exceptions.RequestException as err:
             logging.error( "Couldn't request openweathermap API: Exception {:s}".format(str(err)) )
+            observe_upstream("openweathermap", "geo", start, error=True)
         else:
+            observe_upstream("openweathermap", "geo", start, error=response.status_code != 200)
             if response.status_code == 200:
                 json = response.json()
                 if json:
@@ -170,9 +196,9 @@ class openweathermapAPI:
     #-----------------------------------
     def _read_config(self):
         # read api_key as mandatory entry
-        if len(cfg.get('weather_api_key', '')) < 30:
-            logging.fatal("Invalid api_key. Please set valid key within config.yaml")
-            exit()
+        if len(cfg.get('weather_api_key') or '') < 30:
+            logging.error("Invalid api_key. Please set valid key within config.yaml - no weather data will be retrieved")
+            return
 
         # read locations from config file    
         if cfg.get('weather_locations'):
@@ -339,7 +365,7 @@ class openweathermapAPI:
     #-----------------------------------
     def _prettify_weather(self, location):
         weather = self.weather.get(location)
-        if weather:
+        if weather and weather.get("last_refresh"): # location has been retrieved successfully
             w_dict = {}
             w_dict['base'] = {}
             w_dict['now'] = {}